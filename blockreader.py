@@ -0,0 +1,87 @@
+'''Read an HDF5 volume block by block with the halo that sampling needs
+
+A HaloBlockReader walks a volume in blocks of a plane. For each block it
+reads just the block, the margin the largest sampling ring reaches and,
+if the blurred planes have to be computed, the extra rows and columns that
+blur_plane needs to be exact. It hands back a PaddedVolume of the block
+that samples exactly as a PaddedVolume of the whole volume would and keeps
+nothing once the caller moves to the next block, so memory is bounded by
+the block size rather than the volume size.
+'''
+
+import numpy as np
+from extract_features import reflect, ring_margin, blur_plane, filter_halo
+from paddedvolume import PaddedVolume
+
+class HaloBlockReader(object):
+    '''Read halo-padded blocks of an X x Y x Z HDF5 dataset
+
+    dataset - the ordinal image dataset
+    blur_dataset - an optional X x Y x Z x 2 dataset of the blur_image output,
+                   e.g. from blurcache. If None, each block is blurred as
+                   it is read.
+    block_shape - the size of a block in the first two dimensions
+    codec - if given, the FeatureCodec used to encode the blocks
+    '''
+    def __init__(self, dataset, blur_dataset = None, block_shape = (256, 256),
+                 codec = None):
+        self.dataset = dataset
+        self.codec = codec
+        self.blur_dataset = blur_dataset
+        self.block_shape = tuple(block_shape)
+        self.shape = dataset.shape
+        self.margin = ring_margin()
+        assert self.margin[2] == 0, "Blocks are one plane deep"
+
+    def block_origins(self):
+        '''Return the (x0, y0, k) of each block, in reading order'''
+        return [(x0, y0, k) for k in range(self.shape[2])
+                for x0 in range(0, self.shape[0], self.block_shape[0])
+                for y0 in range(0, self.shape[1], self.block_shape[1])]
+
+    def block_of(self, indices):
+        '''Return the index into block_origins of the block holding each pixel
+
+        indices - an N x 3 array of pixel coordinates
+        '''
+        nx = (self.shape[0] + self.block_shape[0] - 1) / self.block_shape[0]
+        ny = (self.shape[1] + self.block_shape[1] - 1) / self.block_shape[1]
+        return ((indices[:, 2] * nx + indices[:, 0] / self.block_shape[0]) *
+                ny + indices[:, 1] / self.block_shape[1])
+
+    def read(self, x0, y0, k):
+        '''Read the block whose first pixel is at x0, y0, k
+
+        returns a one-plane PaddedVolume of the block. Its pixel 0, 0, 0 is
+        the block's first pixel.
+        '''
+        mx, my, mz = self.margin
+        x1 = min(x0 + self.block_shape[0], self.shape[0])
+        y1 = min(y0 + self.block_shape[1], self.shape[1])
+        x = reflect(np.arange(x0 - mx, x1 + mx), self.shape[0])
+        y = reflect(np.arange(y0 - my, y1 + my), self.shape[1])
+        halo = 0 if self.blur_dataset is not None else filter_halo
+        r0 = max(0, np.min(x) - halo)
+        r1 = min(self.shape[0], np.max(x) + halo + 1)
+        c0 = max(0, np.min(y) - halo)
+        c1 = min(self.shape[1], np.max(y) + halo + 1)
+        img = self.dataset[r0:r1, c0:c1, k]
+        if self.blur_dataset is None:
+            log, gauss, elapsed = blur_plane(img)
+        else:
+            log = self.blur_dataset[r0:r1, c0:c1, k, 0]
+            gauss = self.blur_dataset[r0:r1, c0:c1, k, 1]
+        dtype = img.dtype if self.codec is None else self.codec.dtype
+        planes = np.empty((1, 3, len(x), len(y)), dtype)
+        x, y = x[:, np.newaxis] - r0, y[np.newaxis, :] - c0
+        for c, channel in enumerate((img, log, gauss)):
+            channel = channel[x, y]
+            if self.codec is not None:
+                channel = self.codec.encode_channel(c, channel)
+            planes[0, c] = channel
+        return PaddedVolume(planes, self.margin, self.codec)
+
+    def __iter__(self):
+        '''Iterate over (x0, y0, k, block) for every block of the volume'''
+        for x0, y0, k in self.block_origins():
+            yield x0, y0, k, self.read(x0, y0, k)
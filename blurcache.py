@@ -0,0 +1,85 @@
+'''Cache blur_image outputs in the HDF5 file
+
+Each cached volume is stored in the "blur_cache" group under a key that is
+the MD5 digest of the source volume's data together with the filter
+parameters, so a cached entry can only be found if it was made from the
+same pixels with the same sigmas. Entries made from an earlier version of
+the same source dataset are evicted when a new one is stored.
+'''
+
+import hashlib
+import numpy as np
+import extract_features
+
+CACHE_GROUP = "blur_cache"
+
+def blur_key(img, rows = 64):
+    '''Return the cache key for the blur of an image
+
+    img - an ndarray or an HDF5 dataset, which is read rows at a time
+
+    The key hashes the image's shape, type and pixels along with the sigmas
+    that blur_image uses.
+    '''
+    digest = hashlib.md5()
+    digest.update(repr((img.shape, str(img.dtype),
+                        extract_features.log_sigma,
+                        extract_features.blur_sigma)))
+    for x0 in range(0, img.shape[0], rows):
+        digest.update(np.ascontiguousarray(img[x0:(x0 + rows)]).data)
+    return digest.hexdigest()
+
+def cached_blur_dataset(h5_file, name):
+    '''Return the cached blur dataset for a source dataset or None if not cached
+
+    The source is hashed without reading it all into memory at once.
+    '''
+    if CACHE_GROUP not in h5_file.keys():
+        return None
+    group = h5_file[CACHE_GROUP]
+    key = blur_key(h5_file[name])
+    if key in group.keys():
+        return group[key]
+    return None
+
+def cached_blur_image(h5_file, name, img = None, **kwargs):
+    '''Return blur_image of a dataset, computing it only if it isn't cached
+
+    h5_file - the HDF5 file holding the source and the cache
+    name - the name of the source dataset
+    img - the source dataset's pixels if they have already been read
+    kwargs - passed to blur_image if the blur has to be computed
+
+    returns the X x Y x Z x 2 output of blur_image
+    '''
+    if img is None:
+        img = h5_file[name][:,:,:]
+    key = blur_key(img)
+    group = h5_file.require_group(CACHE_GROUP)
+    if key in group.keys():
+        return group[key][:,:,:,:]
+    #
+    # Evict the stale entries for this source
+    #
+    for stale in [k for k in group.keys() if group[k].attrs["source"] == name]:
+        del group[stale]
+    blur = extract_features.blur_image(img, **kwargs)
+    chunks = tuple([min(c, n) for c, n in zip((64, 64, 5, 2), blur.shape)])
+    ds = group.create_dataset(key, data = blur, chunks = chunks)
+    ds.attrs["source"] = name
+    ds.attrs["log_sigma"] = extract_features.log_sigma
+    ds.attrs["blur_sigma"] = extract_features.blur_sigma
+    return blur
+
+def report_blur(name, timings):
+    '''Print how long blurring took or that the blur came from the cache
+
+    name - the name of the source dataset
+    timings - the seconds per plane that cached_blur_image's timings
+              argument received, all zero if the blur was cached
+    '''
+    if np.any(timings):
+        print "Blurred %d planes, %.2f sec per plane, slowest %.2f sec" % (
+            len(timings), np.mean(timings), np.max(timings))
+    else:
+        print "Loaded the blurred %s from the cache" % name
@@ -0,0 +1,115 @@
+'''Coarse-to-fine scoring that skips confidently classified pixels
+
+Most of a membrane probability map is far from 0.5. The cascade scores a
+subgrid of every step'th pixel, interpolates the subgrid's scores over the
+plane and then scores in full only the pixels whose interpolated score lies
+within band of 0.5. The other pixels keep their interpolated scores.
+'''
+
+import numpy as np
+from scipy.ndimage import map_coordinates
+
+def coarse_grid(n, step):
+    '''Return every step'th index of an axis of length n and the last one'''
+    return np.unique(np.hstack([np.arange(0, n, step), [n - 1]]))
+
+def interpolate_grid(coarse, xs, ys, shape):
+    '''Bilinearly interpolate scores on a subgrid over a whole plane
+
+    coarse - the len(xs) x len(ys) scores of the subgrid
+    xs, ys - the subgrid's indices on each axis
+    shape - the size of the plane
+    '''
+    cx = np.interp(np.arange(shape[0]), xs, np.arange(len(xs)))
+    cy = np.interp(np.arange(shape[1]), ys, np.arange(len(ys)))
+    cx, cy = np.meshgrid(cx, cy, indexing = "ij")
+    return map_coordinates(coarse, [cx, cy], order = 1, mode = "nearest")
+
+def cascade_scores(shape, score_points, step = 4, band = .2):
+    '''Score a plane coarse-to-fine
+
+    shape - the size of the plane
+    score_points - a function of the x and y coordinates of some pixels
+                   that returns a list of each classifier's scores for them
+    step - the spacing of the subgrid that is scored first
+    band - pixels whose interpolated score, for any classifier, is within
+           band of 0.5 are scored in full
+
+    returns a list of each classifier's scores for the plane and the number
+    of pixels that were scored in full, including the subgrid
+    '''
+    xs, ys = coarse_grid(shape[0], step), coarse_grid(shape[1], step)
+    gx, gy = np.meshgrid(xs, ys, indexing = "ij")
+    coarse = score_points(gx.flatten(), gy.flatten())
+    scores = [interpolate_grid(c.reshape(gx.shape), xs, ys, shape)
+              for c in coarse]
+    uncertain = np.zeros(shape, bool)
+    for score in scores:
+        uncertain |= np.abs(score - .5) < band
+    uncertain[gx, gy] = False
+    x, y = np.where(uncertain)
+    if len(x) > 0:
+        for score, fine in zip(scores, score_points(x, y)):
+            score[x, y] = fine
+    for score, c in zip(scores, coarse):
+        score[gx, gy] = c.reshape(gx.shape)
+    return scores, gx.size + len(x)
+
+if __name__ == "__main__":
+    #
+    # Compare the cascade to dense scoring with the raw feature classifier
+    # on planes of the training volume: the fraction of pixels skipped, the
+    # scores' largest difference and the pixel error, the fraction of pixels
+    # whose thresholded label changes.
+    #
+    import time
+    from vigra.learning import RandomForest
+    import tiffcvt
+    from blurcache import cached_blur_image
+    from paddedvolume import PaddedVolume
+    from scheduler import tiles
+    clf = RandomForest("../challenge.h5", "/classifier")
+    img = tiffcvt.h5_file["ordinal_train_volume"][:,:,:]
+    padded = PaddedVolume.from_volume(
+        img, cached_blur_image(tiffcvt.h5_file, "ordinal_train_volume", img))
+    planes = range(0, img.shape[2], max(1, img.shape[2] / 3))
+    def score_points(k):
+        def fn(x, y):
+            scores = np.zeros(len(x), np.float32)
+            for start in range(0, len(x), 4096):
+                end = min(start + 4096, len(x))
+                coords = np.column_stack(
+                    [x[start:end], y[start:end], np.ones(end - start, int) * k])
+                scores[start:end] = clf.predictProbabilities(
+                    padded.sample(coords))[:, 1]
+            return [scores]
+        return fn
+    t0 = time.time()
+    dense = []
+    for k in planes:
+        expected = np.zeros(img.shape[:2], np.float32)
+        for i, j, height, width in tiles(img.shape[:2]):
+            expected[i:(i+height), j:(j+width)] = clf.predictProbabilities(
+                padded.tile_features(i, j, k, (height, width)))[:, 1].reshape(
+                    height, width)
+        dense.append(expected)
+    print "Dense: %.2f sec" % (time.time() - t0)
+    for step in (2, 4, 8):
+        for band in (.1, .2, .3, .4):
+            t0 = time.time()
+            nscored = 0
+            max_error = 0
+            pixel_error = 0
+            for k, expected in zip(planes, dense):
+                (score, ), n = cascade_scores(
+                    img.shape[:2], score_points(k), step, band)
+                nscored += n
+                max_error = max(max_error, np.max(np.abs(score - expected)))
+                pixel_error += np.sum((score > .5) != (expected > .5))
+            elapsed = time.time() - t0
+            npixels = len(planes) * img.shape[0] * img.shape[1]
+            print ("step %d, band %.1f: skipped %.1f%%, %.2f sec, "
+                   "max difference %.3f, pixel error %.4f%%") % (
+                       step, band, 100.0 * (npixels - nscored) / npixels,
+                       elapsed, max_error, 100.0 * pixel_error / npixels)
+    tiffcvt.h5_file.close()
@@ -0,0 +1,120 @@
+'''Record which blocks of a prediction have been scored
+
+A long scoring run writes its predictions block by block. Next to each
+prediction dataset, a companion uint8 dataset holds one flag per block that
+is set once the block's scores are written, so that a restarted run can skip
+the finished blocks. The companion dataset's "key" attribute is a digest of
+the classifier and its inputs, the ordinal volume and the scoring settings
+and its "block_shape" attribute is the block size. If either differs from
+the current run's, the record is discarded and every block is scored again.
+'''
+
+import hashlib
+import h5py
+import numpy as np
+from scipy.ndimage import binary_dilation
+from blurcache import blur_key
+from sampling import disk
+
+DONE_SUFFIX = "_done"
+
+def checkpoint_name(name):
+    '''Return the name of the completion record of a prediction dataset'''
+    return name + DONE_SUFFIX
+
+def group_key(group):
+    '''Return a digest of the names and contents of the datasets in a group
+
+    group - an HDF5 group, e.g. the classifier written by
+            RandomForest.writeHDF5, or a dataset
+    '''
+    digest = hashlib.md5()
+    def visit(name, item):
+        if isinstance(item, h5py.Dataset):
+            digest.update(name)
+            digest.update(np.ascontiguousarray(item[...]).data)
+    if isinstance(group, h5py.Dataset):
+        visit(group.name, group)
+    else:
+        group.visititems(visit)
+    return digest.hexdigest()
+
+def scoring_key(classifier_group, volume, settings, inputs = ()):
+    '''Return the key of a prediction of a volume by a classifier
+
+    classifier_group - the HDF5 group of the classifier
+    volume - the ordinal volume's HDF5 dataset or array
+    settings - a string of the scoring options that change the scores,
+               e.g. the feature precision
+    inputs - the other HDF5 datasets or groups that the classifier's
+             features are computed from, e.g. the eigentexture components
+    '''
+    return "-".join([group_key(classifier_group)] +
+                    [group_key(item) for item in inputs] +
+                    [blur_key(volume), settings])
+
+def checkpoint_dataset(h5_file, name, nblocks, block_shape, key):
+    '''Return the completion record of a prediction dataset
+
+    h5_file - the HDF5 file holding the prediction
+    name - the name of the prediction dataset
+    nblocks - the number of blocks the prediction is scored in
+    block_shape - the size of a block in the first two dimensions
+    key - the scoring_key of the prediction
+
+    The record is created, or recreated if it was made for a different
+    key or block grid, with no blocks done.
+    '''
+    done_name = checkpoint_name(name)
+    if done_name in h5_file.keys():
+        done = h5_file[done_name]
+        if (done.shape != (nblocks, ) or done.attrs["key"] != key or
+            tuple(done.attrs["block_shape"]) != tuple(block_shape)):
+            print "Discarding the finished blocks of %s" % name
+            del h5_file[done_name]
+    if done_name not in h5_file.keys():
+        done = h5_file.create_dataset(done_name, (nblocks, ), np.uint8)
+        done.attrs["key"] = key
+        done.attrs["block_shape"] = block_shape
+    return h5_file[done_name]
+
+def mark_done(h5_file, names, index):
+    '''Record that a block of each of the named predictions is written
+
+    The file is flushed so that the record survives a crash of the run.
+    '''
+    for name in names:
+        h5_file[checkpoint_name(name)][index] = 1
+    h5_file.flush()
+
+def unsettled_pixels(h5_file, name, labels, margin, radius):
+    '''Return a mask of the pixels whose earlier scores should be redone
+
+    h5_file - the HDF5 file holding the prediction
+    name - the name of the prediction dataset
+    labels - the X x Y x Z dataset of the volume's ground truth labels
+    margin - a pixel is unsettled if its score is within margin of 0.5
+    radius - the unsettled pixels are grown by this many pixels in their
+             plane
+
+    A pixel is unsettled if it is misclassified or its score is within the
+    margin, or if it is within radius of such a pixel. A retrained
+    classifier is unlikely to change the labels of the rest, so only the
+    unsettled pixels are rescored. Returns an X x Y x Z boolean array, or
+    None if the last prediction wasn't finished, whichever the classifier,
+    in which case every pixel has to be scored.
+    '''
+    done_name = checkpoint_name(name)
+    if done_name not in h5_file.keys() or not np.all(h5_file[done_name][:]):
+        return None
+    prediction = h5_file[name]
+    footprint = disk(radius)
+    mask = np.zeros(prediction.shape, bool)
+    for k in range(prediction.shape[2]):
+        score = prediction[:, :, k]
+        unsettled = (((score > .5) != (labels[:, :, k] != 0)) |
+                     (np.abs(score - .5) < margin))
+        if radius > 0:
+            unsettled = binary_dilation(unsettled, footprint)
+        mask[:, :, k] = unsettled
+    return mask
@@ -0,0 +1,193 @@
+'''Sample feature vectors from HDF5 volumes a chunk at a time
+
+Gathering scattered pixels from an h5py dataset with fancy indexing reads
+and decompresses a chunk for nearly every pixel, so sampling straight from
+a volume on disk is far slower than from one in memory. A ChunkSampler
+orders the sampled points by the chunk they lie in and gathers their ring
+pixels chunk by chunk from a ChunkCache. Neighboring points share most of
+the chunks that their rings touch, so each chunk is read about once while
+only the cache's chunks are held in memory.
+
+chunk_sampler keeps one ChunkSampler per pair of datasets so that callers
+that sample a few points at a time, e.g. extract_features on an HDF5
+dataset, keep their cached chunks from one call to the next. The ordinal
+volumes are contiguous, so they are read on a grid of DEFAULT_CHUNKS.
+'''
+
+from collections import OrderedDict
+import numpy as np
+from extract_features import reflect, ring_columns, n_features
+
+DEFAULT_CHUNKS = (64, 64, 1)
+#
+# The ChunkSampler of each (file name, image name, blur name)
+#
+samplers = {}
+
+class ChunkCache(object):
+    '''A least-recently-used cache of the chunks of an X x Y x Z dataset
+
+    dataset - an HDF5 dataset or array whose first three axes are X, Y and Z.
+              Any further axes, e.g. the two channels of the blur, are read
+              whole with each chunk.
+    capacity - the number of bytes of chunks to keep
+
+    Chunks are read on the dataset's own chunk grid, or on a grid of
+    DEFAULT_CHUNKS if the dataset isn't chunked.
+    '''
+    def __init__(self, dataset, capacity = 256e6):
+        self.dataset = dataset
+        self.capacity = capacity
+        chunks = getattr(dataset, "chunks", None) or DEFAULT_CHUNKS
+        self.chunk_shape = np.array(chunks[:3])
+        self.grid_shape = (np.array(dataset.shape[:3]) + self.chunk_shape - 1) \
+                          / self.chunk_shape
+        self.chunks = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def chunk_index(self, x, y, z):
+        '''Return the linear index of the chunk holding each pixel'''
+        cx, cy, cz = self.chunk_shape
+        nx, ny, nz = self.grid_shape
+        return ((z / cz) * nx + x / cx) * ny + y / cy
+
+    def chunk(self, index):
+        '''Return the origin and the pixels of a chunk, reading it if need be'''
+        if index in self.chunks:
+            self.hits += 1
+            result = self.chunks.pop(index)
+            self.chunks[index] = result
+            return result
+        self.misses += 1
+        nx, ny, nz = self.grid_shape
+        origin = np.array([(index / ny) % nx, index % ny, index / (nx * ny)]) \
+                 * self.chunk_shape
+        end = np.minimum(origin + self.chunk_shape, self.dataset.shape[:3])
+        pixels = self.dataset[origin[0]:end[0], origin[1]:end[1],
+                              origin[2]:end[2]]
+        self.chunks[index] = (origin, pixels)
+        self.nbytes += pixels.nbytes
+        while self.nbytes > self.capacity and len(self.chunks) > 1:
+            old_origin, old_pixels = self.chunks.popitem(last = False)[1]
+            self.nbytes -= old_pixels.nbytes
+        return origin, pixels
+
+    def gather(self, x, y, z, channel = None):
+        '''Return the pixels at x, y, z, reading each chunk they touch once
+
+        x, y, z - arrays of coordinates within the dataset
+        channel - if given, the index into the dataset's fourth axis
+        '''
+        x, y, z = x.ravel(), y.ravel(), z.ravel()
+        index = self.chunk_index(x, y, z)
+        order = np.argsort(index)
+        index = index[order]
+        starts = np.hstack([[0], np.flatnonzero(index[1:] != index[:-1]) + 1,
+                            [len(index)]])
+        result = np.empty(len(x), self.dataset.dtype)
+        for start, end in zip(starts[:-1], starts[1:]):
+            origin, pixels = self.chunk(index[start])
+            idx = order[start:end]
+            if channel is not None:
+                pixels = pixels[..., channel]
+            result[idx] = pixels[x[idx] - origin[0], y[idx] - origin[1],
+                                 z[idx] - origin[2]]
+        return result
+
+class ChunkSampler(object):
+    '''Extract feature vectors from an image and its blur held on disk
+
+    img - the X x Y x Z ordinal image dataset
+    blur - the X x Y x Z x 2 dataset of its blur_image output
+    capacity - the bytes of chunks to cache for each of the two datasets
+    batch_size - the number of points to gather at once
+
+    sample() returns what extract_features would for the same datasets read
+    into memory.
+    '''
+    def __init__(self, img, blur, capacity = 256e6, batch_size = 4096):
+        self.shape = img.shape
+        self.dtype = img.dtype
+        self.caches = (ChunkCache(img, capacity), ChunkCache(blur, capacity))
+        self.batch_size = batch_size
+
+    def sample(self, indices):
+        '''Return the N x n_features matrix of features of the N x 3 indices'''
+        cache = self.caches[0]
+        order = np.argsort(cache.chunk_index(
+            indices[:, 0], indices[:, 1], indices[:, 2]), kind = "mergesort")
+        result = np.empty((indices.shape[0], n_features), self.dtype)
+        for start in range(0, len(order), self.batch_size):
+            idx = order[start:(start + self.batch_size)]
+            result[idx] = self.sample_batch(indices[idx])
+        return result
+
+    def sample_batch(self, indices):
+        '''Gather the features of a batch of nearby points'''
+        sampler = np.empty((indices.shape[0], n_features), self.dtype)
+        for c, (xfv, offset, end) in enumerate(ring_columns):
+            xyz = [reflect(indices[:, axis, np.newaxis] +
+                           xfv[np.newaxis, :, axis], self.shape[axis])
+                   for axis in range(3)]
+            if c == 0:
+                values = self.caches[0].gather(*xyz)
+            else:
+                values = self.caches[1].gather(*xyz, channel = c - 1)
+            sampler[:, offset:end] = values.reshape(indices.shape[0],
+                                                    end - offset)
+        return sampler
+
+def dataset_key(dataset):
+    '''Return the file and name of an HDF5 dataset, or the id of an array'''
+    if hasattr(dataset, "file"):
+        return (dataset.file.filename, dataset.name)
+    return id(dataset)
+
+def chunk_sampler(img, blur, capacity = 256e6):
+    '''Return the ChunkSampler of an image and its blur, reusing its cache
+
+    img - the X x Y x Z ordinal image dataset
+    blur - the X x Y x Z x 2 dataset of its blur_image output
+    capacity - the bytes of chunks to cache for each of the two datasets
+
+    The sampler of the same datasets is reused as long as their file is
+    open. It isn't told if they are rewritten in the meantime.
+    '''
+    key = (dataset_key(img), dataset_key(blur))
+    sampler = samplers.get(key)
+    if sampler is None or not all([
+        getattr(cache.dataset, "id", None) is None or cache.dataset.id.valid
+        for cache in sampler.caches]):
+        sampler = samplers[key] = ChunkSampler(img, blur, capacity)
+    return sampler
+
+if __name__ == "__main__":
+    #
+    # Compare sampling the training volume on disk with and without the
+    # chunk cache against sampling it in memory.
+    #
+    import time
+    import tiffcvt
+    from blurcache import cached_blur_image, cached_blur_dataset
+    from extract_features import extract_features
+    r = np.random.RandomState()
+    r.seed(12345)
+    volume = tiffcvt.h5_file["ordinal_train_volume"]
+    img = volume[:,:,:]
+    blur = cached_blur_image(tiffcvt.h5_file, "ordinal_train_volume", img)
+    blur_dataset = cached_blur_dataset(tiffcvt.h5_file, "ordinal_train_volume")
+    coords = np.column_stack([r.randint(0, n, 20000) for n in img.shape])
+    t0 = time.time()
+    expected = extract_features(img, blur, coords)
+    t1 = time.time()
+    sampler = ChunkSampler(volume, blur_dataset)
+    result = sampler.sample(coords)
+    t2 = time.time()
+    assert np.all(result == expected), "The chunk sampler doesn't match"
+    print "In memory: %.2f sec, from disk by chunk: %.2f sec" % (t1 - t0, t2 - t1)
+    for name, cache in zip(("image", "blur"), sampler.caches):
+        print "    %s: %d chunks read, %d cache hits" % (
+            name, cache.misses, cache.hits)
+    tiffcvt.h5_file.close()
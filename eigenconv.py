@@ -0,0 +1,113 @@
+'''Compute eigentexture features by convolution
+
+Each eigentexture component is a linear combination of the normalized ring
+samples, so it is also a linear filter over the image, LoG and blurred
+planes: a 19 x 19 kernel per ring, dilated by the ring's step. This module
+applies all of the components to a whole plane at once by FFT correlation,
+overlap-save style over tiles of the padded plane, instead of gathering the
+1083-wide feature vector for every pixel and multiplying by the components.
+'''
+
+import numpy as np
+from extract_features import ring_columns, n_features
+
+class EigenFilterBank(object):
+    '''The eigentexture components as frequency-domain filters
+
+    components - the nkernels x M matrix of eigentexture components
+    means, sds - the per-feature means and standard deviations that
+                 eigentexture.normalize uses
+    margin - the x and y margin of the PaddedVolume that will be filtered
+    tile_size - the size of the output tiles that are filtered at once
+    '''
+    def __init__(self, components, means, sds, margin, tile_size = 256):
+        assert components.shape[1] == n_features
+        mx, my = margin[:2]
+        self.margin = (mx, my)
+        self.tile_size = tile_size
+        self.fft_shape = (tile_size + 2 * mx, tile_size + 2 * my)
+        weights = components / sds[np.newaxis, :]
+        self.bias = np.dot(weights, means)
+        #
+        # Flip each ring's weights about the kernel center so that the
+        # convolution by FFT computes a correlation.
+        #
+        kernels = np.zeros((components.shape[0], 3, 2 * mx + 1, 2 * my + 1))
+        for c, (xfv, offset, end) in enumerate(ring_columns):
+            kernels[:, c, mx - xfv[:, 0], my - xfv[:, 1]] = \
+                weights[:, offset:end]
+        self.kernel_spectra = np.fft.rfft2(
+            kernels, self.fft_shape).astype(np.complex64)
+
+    @property
+    def nkernels(self):
+        return self.kernel_spectra.shape[0]
+
+    def plane(self, padded, k):
+        '''Return the eigenfeatures of every pixel in a plane
+
+        padded - a PaddedVolume with the margin given to the constructor
+        k - the index of the plane
+
+        returns an X x Y x nkernels float32 array whose rows are the same
+        as extract_eigenfeatures' for the plane's pixels
+        '''
+        assert tuple(padded.margin[:2]) == self.margin
+        mx, my = self.margin
+        mz = padded.margin[2]
+        X, Y = padded.shape[:2]
+        result = np.zeros((X, Y, self.nkernels), np.float32)
+        for x0 in range(0, X, self.tile_size):
+            x1 = min(x0 + self.tile_size, X)
+            for y0 in range(0, Y, self.tile_size):
+                y1 = min(y0 + self.tile_size, Y)
+                block = padded.decode_channels(
+                    padded.planes[k + mz, :,
+                                  x0:(x1 + 2 * mx), y0:(y1 + 2 * my)])
+                spectra = np.fft.rfft2(
+                    block, self.fft_shape).astype(np.complex64)
+                accumulator = self.kernel_spectra[:, 0] * spectra[0]
+                for c in range(1, spectra.shape[0]):
+                    accumulator += self.kernel_spectra[:, c] * spectra[c]
+                filtered = np.fft.irfft2(accumulator, self.fft_shape)
+                filtered = filtered[:, (2 * mx):(x1 - x0 + 2 * mx),
+                                    (2 * my):(y1 - y0 + 2 * my)]
+                result[x0:x1, y0:y1, :] = \
+                    filtered.transpose(1, 2, 0) - self.bias[np.newaxis,
+                                                            np.newaxis, :]
+        return result
+
+if __name__ == "__main__":
+    #
+    # Compare the filter bank to extract_eigenfeatures on one plane of the
+    # training volume and time both.
+    #
+    import time
+    import tiffcvt
+    import eigentexture
+    from blurcache import cached_blur_image
+    from extract_features import eigenproject
+    from paddedvolume import PaddedVolume
+    img = tiffcvt.h5_file["ordinal_train_volume"][:,:,:]
+    padded = PaddedVolume.from_volume(
+        img, cached_blur_image(tiffcvt.h5_file, "ordinal_train_volume", img))
+    components = tiffcvt.h5_file["components"][:,:]
+    k = img.shape[2] / 2
+    t0 = time.time()
+    bank = EigenFilterBank(components, eigentexture.means, eigentexture.sds,
+                           padded.margin)
+    t1 = time.time()
+    efeatures = bank.plane(padded, k)
+    t2 = time.time()
+    error = 0
+    for i in range(0, img.shape[0], 64):
+        for j in range(0, img.shape[1], 64):
+            expected = eigenproject(padded.tile_features(i, j, k), components)
+            expected.shape = (64, 64, expected.shape[1])
+            error = max(error, np.max(np.abs(
+                expected - efeatures[i:(i+64), j:(j+64)])))
+    t3 = time.time()
+    print "Filter bank setup: %.2f sec, plane: %.2f sec" % (t1 - t0, t2 - t1)
+    print "Gather and project: %.2f sec, max abs difference: %g" % (
+        t3 - t2, error)
+    tiffcvt.h5_file.close()
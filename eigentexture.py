@@ -6,7 +6,9 @@ import pylab
 nkernels = 48
 
 if __name__ == "__main__":
-    a = h5_file["training_features"][:,:]
+    from featurecodec import FeatureCodec
+    codec = FeatureCodec.load(h5_file["training_features"])
+    a = codec.decode(h5_file["training_features"][:,:])
     
     means = np.mean(a, 0)
     sds = np.std(a, 0)
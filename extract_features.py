@@ -1,23 +1,131 @@
+import itertools
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
 from scipy.ndimage import gaussian_filter, laplace
+import time
 
 fv = np.mgrid[-9:10,-9:10,0:1].reshape(3, 19*19).transpose()
 log_fv = np.mgrid[-27:28:3,-27:28:3,0:1].reshape(3, 19 * 19).transpose()
 blur_fv = np.mgrid[-72:73:8, -72:73:8, 0:1].reshape(3, 19 * 19).transpose()
 n_features = fv.shape[0] + blur_fv.shape[0] + log_fv.shape[0]
+ring_size = 19
+log_sigma = 3
+blur_sigma = 5
+#
+# The distance from the edge of a plane beyond which blur_plane's output
+# doesn't depend on what lies past the edge (gaussian_filter's default
+# truncation at 4 sigma, plus one for the Laplacian)
+#
+filter_halo = max(int(4.0 * log_sigma + 0.5) + 1, int(4.0 * blur_sigma + 0.5))
+#
+# The sampling rings as (offsets, first feature column, end feature column)
+#
+ring_columns = (
+    (fv, 0, fv.shape[0]),
+    (log_fv, fv.shape[0], fv.shape[0] + log_fv.shape[0]),
+    (blur_fv, fv.shape[0] + log_fv.shape[0], n_features))
 
-def blur_image(img):
-    '''Return the blurred image that's used when sampling'''
+def blur_plane(plane):
+    '''Return the LoG and Gaussian blur of one plane and the seconds it took'''
+    t0 = time.time()
+    log = laplace(gaussian_filter(plane, log_sigma))
+    gauss = gaussian_filter(plane, blur_sigma)
+    return log, gauss, time.time() - t0
+
+def blur_image(img, workers = 1, processes = False, timings = None):
+    '''Return the blurred image that's used when sampling
+
+    img - the 3-d image to blur plane by plane
+    workers - the number of planes to filter at once
+    processes - filter the planes in a process pool instead of a thread pool
+    timings - if not None, a sequence with one element per plane that
+              receives the seconds spent filtering that plane
+    '''
     blur = np.zeros(list(img.shape)+[2], img.dtype)
-    for z in range(img.shape[2]):
-        blur[:,:,z, 0] = laplace(gaussian_filter(img[:,:,z], 3))
-        blur[:,:,z, 1] = gaussian_filter(img[:,:,z], 5)
+    planes = [img[:,:,z] for z in range(img.shape[2])]
+    if workers > 1:
+        pool = (Pool if processes else ThreadPool)(workers)
+        results = pool.imap(blur_plane, planes)
+    else:
+        pool = None
+        results = itertools.imap(blur_plane, planes)
+    try:
+        for z, (log, gauss, elapsed) in enumerate(results):
+            blur[:,:,z, 0] = log
+            blur[:,:,z, 1] = gauss
+            if timings is not None:
+                timings[z] = elapsed
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
     return blur
 
+def rings(img, blur):
+    '''Return the sampling rings as (offsets, image, start column, end column)'''
+    ximgs = (img, blur[:,:,:,0], blur[:,:,:,1])
+    return tuple([(xfv, ximg, offset, end) for (xfv, offset, end), ximg
+                  in zip(ring_columns, ximgs)])
+
+def feature_geometry():
+    '''Return the channel and the x, y and z offsets of each feature
+
+    returns a vector of the channel (0 for the image, 1 for the LoG and 2 for
+    the blur) that each feature samples and an M x 3 matrix of the offsets
+    '''
+    channel = np.zeros(n_features, int)
+    offsets = np.zeros((n_features, 3), int)
+    for c, (xfv, offset, end) in enumerate(ring_columns):
+        channel[offset:end] = c
+        offsets[offset:end] = xfv
+    return channel, offsets
+
+def ring_margin():
+    '''Return the largest offset, per axis, that any sampling ring reaches'''
+    return tuple([max([int(np.max(np.abs(xfv[:, axis])))
+                       for xfv, _, _ in ring_columns])
+                  for axis in range(3)])
+
+def ring_geometry(xfv):
+    '''Return the radius and step of a sampling ring's offsets'''
+    return int(xfv[-1, 0]), int(xfv[1, 1] - xfv[0, 1])
+
+def reflect(x, n):
+    '''Reflect out-of-bounds indices back into the range, 0 to n-1
+
+    Negative indices are mirrored about zero and indices past the end are
+    mirrored about the edge so that the edge pixel is repeated. This is the
+    boundary rule that extract_features uses.
+    '''
+    x = np.abs(x)
+    return np.where(x >= n, n * 2 - x - 1, x)
+
+def ring_windows(padded, xfv, shape):
+    '''View a padded plane as the ring samples of a tile of pixels
+
+    padded - a 2-d array whose first element is the sample at the ring's most
+             negative offset from the tile's first pixel
+    xfv - the ring's offsets
+    shape - the tile's shape
+
+    returns a read-only shape[0] x shape[1] x 19 x 19 view of the samples
+    '''
+    radius, step = ring_geometry(xfv)
+    s0, s1 = padded.strides
+    assert padded.shape[0] >= shape[0] + 2 * radius
+    assert padded.shape[1] >= shape[1] + 2 * radius
+    windows = as_strided(padded,
+                         (shape[0], shape[1], ring_size, ring_size),
+                         (s0, s1, s0 * step, s1 * step))
+    windows.flags.writeable = False
+    return windows
+
 def extract_features(img, blur, indices):
     '''Extract the feature vector from a portion of the image
     
-    img - a 3-d ndarray'ish object
+    img - a 3-d ndarray or HDF5 dataset
     blur_img - image blurred with blur_image
     indices - an Nx3 array of indices of the pixels to have their values
               sampled.
@@ -28,14 +136,15 @@ def extract_features(img, blur, indices):
               
     returns an NxM matrix of features where M is the width of the feature vector
     
+    An HDF5 dataset is sampled a chunk at a time by a ChunkSampler instead
+    of being gathered pixel by pixel. The sampler and its cached chunks are
+    kept for the next call on the same datasets.
     '''
-    log_img = blur[:,:,:,0]
-    blur_img = blur[:,:,:,1]
+    if not isinstance(img, np.ndarray):
+        from chunksampler import chunk_sampler
+        return chunk_sampler(img, blur).sample(indices)
     sampler = np.ones((indices.shape[0], n_features), img.dtype)
-    for xfv, ximg, offset, end in (
-        (fv, img, 0, fv.shape[0]), 
-        (log_fv, log_img, fv.shape[0], fv.shape[0] + log_fv.shape[0]),
-        (blur_fv, blur_img, fv.shape[0] + log_fv.shape[0], n_features)):
+    for xfv, ximg, offset, end in rings(img, blur):
         x = (indices[:, 0, np.newaxis] + xfv[np.newaxis, :, 0])
         y = (indices[:, 1, np.newaxis] + xfv[np.newaxis, :, 1])
         z = (indices[:, 2, np.newaxis] + xfv[np.newaxis, :, 2])
@@ -51,9 +160,69 @@ def extract_features(img, blur, indices):
         sampler[:, offset:end] = ximg[x, y, z]
     return sampler
 
-def extract_eigenfeatures(img, blur_img, components, indices):
+def extract_tile_features(img, blur, i, j, k, shape = (64, 64)):
+    '''Extract the feature vectors for a dense tile of pixels
+
+    img - a 3-d ndarray
+    blur - image blurred with blur_image
+    i, j, k - the coordinates of the tile's first pixel
+    shape - the size of the tile in the first two dimensions
+
+    returns the same matrix as extract_features does for the indices,
+    np.mgrid[i:i+shape[0], j:j+shape[1], k:k+1].reshape(3, -1).transpose(),
+    but each ring is read from strided windows over a reflected copy of
+    the tile's neighborhood instead of being gathered pixel by pixel.
+    '''
+    sampler = np.empty((shape[0] * shape[1], n_features), img.dtype)
+    for xfv, ximg, offset, end in rings(img, blur):
+        radius, step = ring_geometry(xfv)
+        x = reflect(np.arange(i - radius, i + shape[0] + radius),
+                    ximg.shape[0])
+        y = reflect(np.arange(j - radius, j + shape[1] + radius),
+                    ximg.shape[1])
+        padded = ximg[x[:, np.newaxis], y[np.newaxis, :], k]
+        target = sampler[:, offset:end]
+        target.shape = (shape[0], shape[1], ring_size, ring_size)
+        target[:] = ring_windows(padded, xfv, shape)
+    return sampler
+
+def eigenproject(features, components):
+    '''Project feature vectors onto the eigentexture components'''
     from eigentexture import normalize
-    features = extract_features(img, blur_img, indices)
     features = normalize(features)
     efeatures = np.dot(features, components.transpose())
     return efeatures
+
+def extract_eigenfeatures(img, blur_img, components, indices):
+    return eigenproject(extract_features(img, blur_img, indices), components)
+
+def extract_tile_eigenfeatures(img, blur_img, components, i, j, k,
+                               shape = (64, 64)):
+    return eigenproject(extract_tile_features(img, blur_img, i, j, k, shape),
+                        components)
+
+if __name__ == "__main__":
+    #
+    # Check the dense tile extractor against the per-pixel sampler on
+    # the corner, edge and center tiles of the training volume and time both.
+    #
+    import tiffcvt
+    img = tiffcvt.h5_file["ordinal_train_volume"][:,:,:]
+    blur = blur_image(img)
+    k = img.shape[2] / 2
+    sampler_time = dense_time = 0
+    for i in (0, img.shape[0] / 2 - 32, img.shape[0] - 64):
+        for j in (0, img.shape[1] / 2 - 32, img.shape[1] - 64):
+            coords = np.mgrid[i:(i+64), j:(j+64), k:(k+1)].reshape(3, 64*64)
+            t0 = time.time()
+            expected = extract_features(img, blur, coords.transpose())
+            t1 = time.time()
+            result = extract_tile_features(img, blur, i, j, k)
+            t2 = time.time()
+            assert np.all(expected == result), \
+                   "Tile %d, %d, %d does not match" % (i, j, k)
+            sampler_time += t1 - t0
+            dense_time += t2 - t1
+    print "Sampler: %.3f sec, dense tiles: %.3f sec, speedup: %.1fx" % (
+        sampler_time, dense_time, sampler_time / dense_time)
+    tiffcvt.h5_file.close()
@@ -0,0 +1,149 @@
+'''Reuse the feature vectors of a training set when the set is remade
+
+training_set.py stores the coordinate of each row of "training_features" as
+a linear index in the "training_index" dataset. When the training set is
+refined, its points are drawn from the same sample of the membrane, the
+band around it and the background as the last set's, so most of them were
+in the last set. Their rows are copied instead of being extracted again
+and only the new points, mostly the errors, are extracted.
+The index's "key" attribute is the blur_key of the ordinal volume, so the
+rows are only reused if they were sampled from the same pixels with the
+same filters and the same feature codec.
+'''
+
+import numpy as np
+from blurcache import blur_key
+from extract_features import n_features
+from featurecodec import FeatureCodec
+from featurelayout import create_feature_dataset, open_feature_dataset, \
+     has_layout
+
+FEATURES_NAME = "training_features"
+INDEX_NAME = "training_index"
+NEW_SUFFIX = "_new"
+SWAP_SUFFIX = "_swap"
+
+def linear_index(coords, shape):
+    '''Return the linear index of each x, y, z coordinate
+
+    coords - an N x 3 array of coordinates
+    shape - the shape of the volume
+
+    The indices sort in the same order as np.lexsort(coords.transpose()).
+    '''
+    return np.ravel_multi_index(coords.transpose(), shape, order = "F")
+
+class FeatureCache(object):
+    '''The feature vectors of the last training set, by coordinate
+
+    h5_file - the HDF5 file holding the training set
+    volume - the ordinal volume dataset the features are sampled from
+    codec - the FeatureCodec the new training set is stored with
+
+    If the stored set was made from a different volume or with a different
+    codec, the cache is empty.
+    '''
+    def __init__(self, h5_file, volume, codec):
+        self.h5_file = h5_file
+        self.shape = volume.shape
+        self.key = blur_key(volume)
+        self.index = np.zeros(0, np.int64)
+        self.dataset = None
+        if FEATURES_NAME not in h5_file.keys() or \
+           INDEX_NAME not in h5_file.keys():
+            return
+        dataset = open_feature_dataset(h5_file, FEATURES_NAME)
+        index = h5_file[INDEX_NAME]
+        old_codec = FeatureCodec.load(dataset)
+        if (index.attrs.get("key") != self.key or
+            dataset.shape[1] != n_features or
+            dataset.shape[0] < index.shape[0] or
+            old_codec.precision != codec.precision or
+            np.any(old_codec.channel_scale != codec.channel_scale) or
+            np.any(old_codec.channel_offset != codec.channel_offset)):
+            print "Discarding the cached training features"
+            return
+        self.dataset = dataset
+        self.index = index[:]
+        self.order = np.argsort(self.index, kind = "mergesort")
+        self.sorted_index = self.index[self.order]
+
+    def __len__(self):
+        return len(self.index)
+
+    def rows(self, coords):
+        '''Return the cached row of each coordinate or -1 if it has none'''
+        result = -np.ones(coords.shape[0], int)
+        if len(self.index) == 0:
+            return result
+        linear = linear_index(coords, self.shape)
+        position = np.minimum(np.searchsorted(self.sorted_index, linear),
+                              len(self.index) - 1)
+        hit = self.sorted_index[position] == linear
+        result[hit] = self.order[position[hit]]
+        return result
+
+    def read(self, rows):
+        '''Read the features of cached rows, given in ascending order'''
+        if len(rows) == 0:
+            return np.zeros((0, n_features), self.dataset.dtype)
+        if rows[-1] - rows[0] < 4 * len(rows):
+            return self.dataset[rows[0]:(rows[-1] + 1), :][rows - rows[0]]
+        unique, inverse = np.unique(rows, return_inverse = True)
+        return self.dataset[unique.tolist(), :][inverse]
+
+    def create_dataset(self, nrows, codec, layout = "contiguous"):
+        '''Return the dataset to write the new training set's features to
+
+        The new set is written beside the old one so that the old rows can
+        be copied. store() swaps the two, so the set before last is kept
+        and is written over when its shape, type and layout match. HDF5
+        doesn't reuse the space of deleted datasets, so the file would
+        otherwise grow by a feature matrix each time. The layout is one of
+        featurelayout's layouts.
+        '''
+        name = FEATURES_NAME + NEW_SUFFIX
+        shape = (nrows, n_features)
+        if name in self.h5_file.keys():
+            dataset = self.h5_file[name]
+            if (dataset.shape == shape and dataset.dtype == codec.dtype and
+                has_layout(dataset, layout)):
+                del dataset
+                dataset = open_feature_dataset(self.h5_file, name)
+                codec.save(dataset)
+                return dataset
+            print "Replacing the spare training feature matrix"
+            del dataset
+            del self.h5_file[name]
+        dataset = create_feature_dataset(self.h5_file, name, shape,
+                                         codec.dtype, layout)
+        codec.save(dataset)
+        return dataset
+
+    def store(self, dataset, coords):
+        '''Make a new training set the cached one
+
+        dataset - the dataset from create_dataset
+        coords - the N x 3 coordinates of its first N rows
+
+        The old features are kept under the spare name for create_dataset
+        and the index is resized in place.
+        '''
+        spare = FEATURES_NAME + NEW_SUFFIX
+        if FEATURES_NAME in self.h5_file.keys():
+            self.h5_file.move(FEATURES_NAME, FEATURES_NAME + SWAP_SUFFIX)
+            self.h5_file.move(spare, FEATURES_NAME)
+            self.h5_file.move(FEATURES_NAME + SWAP_SUFFIX, spare)
+        else:
+            self.h5_file.move(dataset.name, FEATURES_NAME)
+        linear = linear_index(coords, self.shape)
+        if INDEX_NAME in self.h5_file.keys() and \
+           self.h5_file[INDEX_NAME].maxshape != (None,):
+            del self.h5_file[INDEX_NAME]
+        if INDEX_NAME not in self.h5_file.keys():
+            self.h5_file.create_dataset(INDEX_NAME, (0,), np.int64,
+                                        maxshape = (None,), chunks = (65536,))
+        index = self.h5_file[INDEX_NAME]
+        index.resize(linear.shape)
+        index[:] = linear
+        index.attrs["key"] = self.key
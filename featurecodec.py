@@ -0,0 +1,185 @@
+'''Compact storage types for feature vectors
+
+Features are sampled from three channels: the ordinal image, its LoG and its
+Gaussian blur. The ordinal image and its blur lie in [0, 1] and the LoG of
+an image in [0, 1] is bounded by the positive and negative sums of the LoG
+kernel, so each channel can be quantized to 8 or 16 bits with a fixed
+scale and offset. The LoG of the training volume only spans about a quarter
+of that bound, which would leave most of the 8-bit codes unused, so
+FeatureCodec.fit takes the LoG channel's range from the blurred volume
+instead. A FeatureCodec encodes channels or feature vectors into
+the selected type and decodes them back to float32 for the classifiers.
+The scale and offset are stored as attributes of the HDF5 dataset that
+holds the codes.
+'''
+
+import numpy as np
+from scipy.ndimage import gaussian_filter, laplace
+import extract_features
+from extract_features import ring_columns, n_features
+from options import get_option
+
+PRECISIONS = ("float32", "float16", "uint16", "uint8")
+
+def channel_ranges():
+    '''Return the low and high bounds of the image, LoG and blur channels'''
+    impulse = np.zeros([4 * extract_features.filter_halo + 1] * 2)
+    impulse[impulse.shape[0] / 2, impulse.shape[1] / 2] = 1
+    kernel = laplace(gaussian_filter(impulse, extract_features.log_sigma))
+    return (np.array([0, np.sum(kernel[kernel < 0]), 0]),
+            np.array([1, np.sum(kernel[kernel > 0]), 1]))
+
+def parse_precision(argv, default = "float32"):
+    '''Return the precision given by a --precision=<type> argument'''
+    precision = get_option(argv, "precision", default)
+    assert precision in PRECISIONS, \
+           "Precision must be one of %s" % ", ".join(PRECISIONS)
+    return precision
+
+class FeatureCodec(object):
+    '''Encode features as one of PRECISIONS and decode them as float32
+
+    precision - the name of the storage type
+    channel_scale, channel_offset - the scale and offset of the image, LoG
+        and blur channels. The defaults spread channel_ranges() over the
+        storage type's range for the integer types and are 1 and 0 for
+        the floating-point types.
+    '''
+    def __init__(self, precision = "float32",
+                 channel_scale = None, channel_offset = None):
+        assert precision in PRECISIONS
+        self.precision = precision
+        self.dtype = np.dtype(precision)
+        self.is_integer = self.dtype.kind == "u"
+        if channel_scale is None:
+            if self.is_integer:
+                low, high = channel_ranges()
+                channel_scale = (high - low) / np.iinfo(self.dtype).max
+                channel_offset = low
+            else:
+                channel_scale, channel_offset = np.ones(3), np.zeros(3)
+        self.channel_scale = np.array(channel_scale, np.float32)
+        self.channel_offset = np.array(channel_offset, np.float32)
+        self.scale = np.zeros(n_features, np.float32)
+        self.offset = np.zeros(n_features, np.float32)
+        for c, (xfv, start, end) in enumerate(ring_columns):
+            self.scale[start:end] = self.channel_scale[c]
+            self.offset[start:end] = self.channel_offset[c]
+
+    def encode_channel(self, c, values):
+        '''Encode the values of channel c'''
+        if not self.is_integer:
+            return values.astype(self.dtype, copy = False)
+        codes = np.round((values - self.channel_offset[c]) /
+                         self.channel_scale[c])
+        return np.clip(codes, 0, np.iinfo(self.dtype).max).astype(self.dtype)
+
+    def encode(self, features):
+        '''Encode an N x M matrix of features'''
+        if not self.is_integer:
+            return features.astype(self.dtype, copy = False)
+        codes = np.round((features - self.offset[np.newaxis, :]) /
+                         self.scale[np.newaxis, :])
+        return np.clip(codes, 0, np.iinfo(self.dtype).max).astype(self.dtype)
+
+    def decode_channels(self, codes):
+        '''Decode a 3 x ... array of image, LoG and blur codes'''
+        if not self.is_integer:
+            return codes.astype(np.float32, copy = False)
+        shape = [3] + [1] * (codes.ndim - 1)
+        return (codes.astype(np.float32) * self.channel_scale.reshape(shape) +
+                self.channel_offset.reshape(shape))
+
+    def decode(self, codes):
+        '''Decode an N x M matrix of feature codes'''
+        if not self.is_integer:
+            return codes.astype(np.float32, copy = False)
+        return (codes.astype(np.float32) * self.scale[np.newaxis, :] +
+                self.offset[np.newaxis, :])
+
+    def save(self, dataset):
+        '''Record the codec in the attributes of the dataset of codes'''
+        dataset.attrs["precision"] = self.precision
+        dataset.attrs["channel_scale"] = self.channel_scale
+        dataset.attrs["channel_offset"] = self.channel_offset
+
+    @classmethod
+    def fit(cls, precision, blur, rows = 64):
+        '''Return a codec whose LoG range is the range of a blurred volume's
+
+        precision - the name of the storage type
+        blur - the X x Y x Z x 2 output of blur_image, an ndarray or an HDF5
+               dataset, which is read rows at a time. If it is None, e.g.
+               when blocks are blurred as they are read, the LoG keeps the
+               kernel's bound.
+
+        The image and blur channels keep their fixed ranges and the
+        floating-point types are unscaled.
+        '''
+        dtype = np.dtype(precision)
+        if dtype.kind != "u" or blur is None:
+            return cls(precision)
+        low, high = channel_ranges()
+        log_low, log_high = np.inf, -np.inf
+        for x0 in range(0, blur.shape[0], rows):
+            log = blur[x0:(x0 + rows), :, :, 0]
+            log_low = min(log_low, np.min(log))
+            log_high = max(log_high, np.max(log))
+        if log_high > log_low:
+            low[1], high[1] = log_low, log_high
+        return cls(precision, (high - low) / np.iinfo(dtype).max, low)
+
+    @classmethod
+    def load(cls, dataset):
+        '''Return the codec of a dataset of codes
+
+        Datasets written before codecs were recorded are float32.
+        '''
+        if "precision" not in dataset.attrs.keys():
+            return cls()
+        return cls(str(dataset.attrs["precision"]),
+                   dataset.attrs["channel_scale"],
+                   dataset.attrs["channel_offset"])
+
+if __name__ == "__main__":
+    #
+    # Compare the precisions on a sample of the training volume: the bytes
+    # per feature vector, the sampling time, the decoding error and, if
+    # there is a trained classifier, how often its predictions change.
+    #
+    import time
+    import tiffcvt
+    from blurcache import cached_blur_image
+    from paddedvolume import PaddedVolume
+    r = np.random.RandomState()
+    r.seed(12345)
+    img = tiffcvt.h5_file["ordinal_train_volume"][:,:,:]
+    blur = cached_blur_image(tiffcvt.h5_file, "ordinal_train_volume", img)
+    coords = np.column_stack([r.randint(0, n, 50000) for n in img.shape])
+    try:
+        from vigra.learning import RandomForest
+        clf = RandomForest("../challenge.h5", "/classifier")
+    except Exception:
+        clf = None
+    expected = None
+    for precision in PRECISIONS:
+        codec = FeatureCodec.fit(precision, blur)
+        padded = PaddedVolume.from_volume(img, blur, codec = codec)
+        t0 = time.time()
+        codes = padded.sample(coords)
+        t1 = time.time()
+        features = codec.decode(codes)
+        t2 = time.time()
+        if expected is None:
+            expected = features
+            if clf is not None:
+                expected_class = clf.predictLabels(expected)
+        error = np.abs(features - expected)
+        print "%s: %d bytes/vector, sample %.2f sec, decode %.2f sec" % (
+            precision, codes.shape[1] * codes.itemsize, t1 - t0, t2 - t1)
+        print "    max error %g, mean error %g" % (
+            np.max(error), np.mean(error))
+        if clf is not None:
+            print "    %.3f%% of predictions changed" % (
+                100.0 * np.mean(clf.predictLabels(features) != expected_class))
+    tiffcvt.h5_file.close()
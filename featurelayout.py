@@ -0,0 +1,144 @@
+'''Storage layouts of feature matrices in HDF5
+
+A layout is given as <chunking>[-<compression>], e.g. --layout=columns-lzf.
+
+chunking is one of
+    contiguous - an unchunked matrix, which can't be compressed
+    rows - chunks of ROW_CHUNK whole feature vectors, for reading rows
+    columns - chunks of COLUMN_CHUNK rows by features, for reading a subset
+              of the features, e.g. the columns a classifier splits on
+
+compression is lzf or gzip and is applied after byte-shuffling the values,
+which groups the similar high bytes of neighboring features. Feature
+matrices are written a band of rows at a time, so a chunked matrix is opened
+with a chunk cache that holds all of the chunks of a band. Otherwise a
+chunk that is partly written would be compressed and written each time a
+band touches it.
+'''
+
+import h5py
+import numpy as np
+from options import get_option
+
+CHUNKINGS = ("contiguous", "rows", "columns")
+COMPRESSIONS = ("lzf", "gzip")
+ROW_CHUNK = 256
+COLUMN_CHUNK = (4096, 64)
+#
+# The rows in a band of writes or reads, e.g. training_set.py's slices
+#
+BAND_ROWS = 1024
+
+def parse_layout(argv, default = "contiguous"):
+    '''Return the layout given by a --layout=<layout> argument'''
+    layout = get_option(argv, "layout", default)
+    layout_options(layout, (1, 1))
+    return layout
+
+def layout_options(layout, shape):
+    '''Return the create_dataset keyword arguments of a layout
+
+    layout - the layout's name, <chunking>[-<compression>]
+    shape - the N x M shape of the feature matrix
+    '''
+    parts = layout.split("-")
+    chunking = parts[0]
+    compression = parts[1] if len(parts) > 1 else None
+    assert len(parts) <= 2 and chunking in CHUNKINGS, \
+           "The chunking must be one of %s" % ", ".join(CHUNKINGS)
+    assert compression is None or compression in COMPRESSIONS, \
+           "The compression must be one of %s" % ", ".join(COMPRESSIONS)
+    if chunking == "contiguous":
+        assert compression is None, "Only chunked layouts can be compressed"
+        return {}
+    if chunking == "rows":
+        chunks = (ROW_CHUNK, shape[1])
+    else:
+        chunks = COLUMN_CHUNK
+    options = dict(chunks = tuple([max(1, min(c, n))
+                                   for c, n in zip(chunks, shape)]))
+    if compression is not None:
+        options.update(compression = compression, shuffle = True)
+    return options
+
+def has_layout(dataset, layout):
+    '''Return True if a feature matrix dataset is stored with a layout'''
+    options = layout_options(layout, dataset.shape)
+    return (dataset.chunks == options.get("chunks") and
+            dataset.compression == options.get("compression") and
+            dataset.shuffle == options.get("shuffle", False))
+
+def create_feature_dataset(group, name, shape, dtype, layout = "contiguous"):
+    '''Create a feature matrix dataset with a layout and open it for writing'''
+    group.create_dataset(name, shape, dtype, **layout_options(layout, shape))
+    return open_feature_dataset(group, name)
+
+def open_feature_dataset(group, name, band_rows = BAND_ROWS):
+    '''Open a feature matrix with a chunk cache that holds a band of rows
+
+    group - the HDF5 file or group holding the dataset
+    name - the dataset's name
+    band_rows - the number of rows that are read or written at once
+    '''
+    dataset = group[name]
+    if dataset.chunks is None:
+        return dataset
+    chunk_rows, chunk_columns = dataset.chunks
+    nchunks = ((band_rows + chunk_rows - 1) / chunk_rows + 1) * \
+              ((dataset.shape[1] + chunk_columns - 1) / chunk_columns)
+    nbytes = nchunks * chunk_rows * chunk_columns * dataset.dtype.itemsize
+    #
+    # An open dataset keeps the chunk cache it was first opened with
+    #
+    del dataset
+    dapl = h5py.h5p.create(h5py.h5p.DATASET_ACCESS)
+    dapl.set_chunk_cache(max(521, nchunks * 100 + 1), nbytes, 1.0)
+    return h5py.Dataset(h5py.h5d.open(group.id, name, dapl))
+
+if __name__ == "__main__":
+    #
+    # Write the training features in each layout to a scratch file and
+    # report the file's size, the write time, the time to read the whole
+    # matrix and the time to read the columns of the blur ring.
+    #
+    import os
+    import tempfile
+    import time
+    import tiffcvt
+    from extract_features import ring_columns
+    features = tiffcvt.h5_file["training_features"][:,:]
+    tiffcvt.h5_file.close()
+    blur_start, blur_end = ring_columns[2][1:]
+    layouts = ["contiguous"] + ["%s%s" % (chunking, suffix)
+                                for chunking in CHUNKINGS[1:]
+                                for suffix in [""] + ["-" + compression
+                                                      for compression
+                                                      in COMPRESSIONS]]
+    print "%-16s %10s %8s %8s %8s" % (
+        "layout", "MB", "write", "read", "columns")
+    for layout in layouts:
+        fd, path = tempfile.mkstemp(".h5")
+        os.close(fd)
+        try:
+            h5_file = h5py.File(path, "w")
+            t0 = time.time()
+            dataset = create_feature_dataset(h5_file, "training_features",
+                                             features.shape, features.dtype,
+                                             layout)
+            for i in range(0, features.shape[0], BAND_ROWS):
+                dataset[i:(i + BAND_ROWS), :] = features[i:(i + BAND_ROWS)]
+            del dataset
+            h5_file.close()
+            t1 = time.time()
+            h5_file = h5py.File(path, "r")
+            result = open_feature_dataset(h5_file, "training_features")[:,:]
+            t2 = time.time()
+            open_feature_dataset(h5_file, "training_features")[
+                :, blur_start:blur_end]
+            t3 = time.time()
+            h5_file.close()
+            assert np.all(result == features)
+            print "%-16s %10.1f %8.2f %8.2f %8.2f" % (
+                layout, os.path.getsize(path) / 1e6, t1 - t0, t2 - t1, t3 - t2)
+        finally:
+            os.remove(path)
@@ -0,0 +1,336 @@
+'''Read the trees of a vigra RandomForest saved with writeHDF5
+
+RandomForest.writeHDF5 stores each tree in a "Tree_<n>" group of the
+forest's group as two datasets: "topology", an int32 array of nodes, and
+"parameters", a float64 array of the nodes' weights, thresholds and leaf
+probabilities. The topology starts with the feature count and class count
+and the root node is at index 2. Each node starts with its type and the
+address of its parameters:
+
+threshold node - type, parameter address, left child, right child, column;
+                 parameters are weight, threshold. A feature vector goes
+                 left if its value in the column is less than the threshold.
+leaf node      - type (with LEAF_NODE_TAG set), parameter address;
+                 parameters are weight, class probabilities.
+
+A Forest holds the trees as flat node arrays and predicts by walking every
+tree for a whole batch of feature vectors at once, one level per step.
+'''
+
+from multiprocessing.pool import ThreadPool
+import numpy as np
+
+TREE_PREFIX = "Tree_"
+LEAF_NODE_TAG = 0x40000000
+TO_BE_PRUNED_TAG = 0x80000000
+NODE_TYPE_MASK = 0x7FFFFFFF
+I_THRESHOLD_NODE = 0
+E_CONST_PROB_NODE = LEAF_NODE_TAG
+ROOT = 2
+OPTIONS_GROUP = "_options"
+
+def tree_names(group):
+    '''Return the names of a forest group's tree groups in tree order'''
+    names = [name for name in group.keys() if name.startswith(TREE_PREFIX)]
+    names.sort(key = lambda name: int(name[len(TREE_PREFIX):]))
+    return names
+
+def read_trees(group):
+    '''Return a list of (topology, parameters) arrays, one per tree
+
+    group - the HDF5 group written by RandomForest.writeHDF5,
+            e.g. h5_file["classifier"]
+    '''
+    return [(group[name]["topology"][:].astype(np.int64),
+             group[name]["parameters"][:].astype(np.float64))
+            for name in tree_names(group)]
+
+def merge_forests(groups, dest):
+    '''Copy the trees of several forests into one forest
+
+    groups - the HDF5 groups of forests written by RandomForest.writeHDF5,
+             e.g. forests trained on the same set with different seeds
+    dest - the empty HDF5 group of the merged forest
+
+    The merged forest has the first forest's options and parameters and
+    the trees of every forest, numbered in order, so it predicts the
+    average of the forests weighted by their tree counts.
+    '''
+    first = groups[0]
+    for key, value in first.attrs.items():
+        dest.attrs[key] = value
+    for name in first.keys():
+        if not name.startswith(TREE_PREFIX):
+            first.copy(name, dest)
+    width = min([len(name) - len(TREE_PREFIX) for name in tree_names(first)])
+    ntrees = 0
+    for group in groups:
+        for name in tree_names(group):
+            group.copy(name, dest, "%s%0*d" % (TREE_PREFIX, width, ntrees))
+            ntrees += 1
+    if OPTIONS_GROUP in dest.keys() and \
+       "tree_count_" in dest[OPTIONS_GROUP].keys():
+        dest[OPTIONS_GROUP]["tree_count_"][...] = ntrees
+    return ntrees
+
+def node_type(topology, index):
+    '''Return the type of the node at index, without the pruning tag
+
+    The topology is stored as int32, so a tagged node is negative once
+    widened. Its uint32 bits are masked instead.
+    '''
+    return (int(topology[index]) & 0xFFFFFFFF) & NODE_TYPE_MASK
+
+def is_leaf(topology, index):
+    return (topology[index] & LEAF_NODE_TAG) != 0
+
+def tree_nodes(topology):
+    '''Return the topology indices of a tree's nodes, parents before children'''
+    nodes = []
+    pending = [ROOT]
+    while len(pending) > 0:
+        index = pending.pop()
+        nodes.append(index)
+        if not is_leaf(topology, index):
+            if node_type(topology, index) != I_THRESHOLD_NODE:
+                raise ValueError(
+                    "Unknown random forest node type: 0x%08x" %
+                    node_type(topology, index))
+            pending += [topology[index + 3], topology[index + 2]]
+    return nodes
+
+def used_features(trees):
+    '''Return the sorted indices of the features that any tree splits on'''
+    columns = set()
+    for topology, parameters in trees:
+        for index in tree_nodes(topology):
+            if not is_leaf(topology, index):
+                columns.add(int(topology[index + 4]))
+    return np.array(sorted(columns), int)
+
+class Forest(object):
+    '''A random forest's trees as flat node arrays for vectorized prediction
+
+    trees - the list of (topology, parameters) arrays from read_trees
+    weighted - if True, each leaf's class probabilities are scaled by its
+               weight, as vigra does when predict_weighted_ is set
+    threads - the number of threads that walk the trees
+    early_exit - if given, trees are walked this many at a time and a row
+                 stops once the trees that are left can't move its class 1
+                 probability across 0.5. Its probability is then that of
+                 the trees walked so far.
+    tolerance - with early_exit, a row also stops once its probability is
+                within tolerance of what all the trees would give
+
+    The nodes of all trees are numbered consecutively. Each node has a
+    feature column, a threshold and left and right children; a leaf is its
+    own left and right child and has class probabilities.
+    '''
+    def __init__(self, trees, weighted = False, threads = 1,
+                 early_exit = None, tolerance = 0):
+        assert early_exit is None or not weighted, \
+               "Early exit needs unweighted leaves"
+        self.threads = threads
+        self.early_exit = early_exit
+        self.tolerance = tolerance
+        #
+        # The number of trees walked and rows predicted, for the average
+        # number of trees per row.
+        #
+        self.trees_walked = 0
+        self.rows_predicted = 0
+        self.nclasses = int(trees[0][0][1])
+        feature, threshold, left, right, leaf, probabilities = \
+            [], [], [], [], [], []
+        self.roots = []
+        for topology, parameters in trees:
+            nodes = tree_nodes(topology)
+            node_id = dict([(index, len(feature) + n)
+                            for n, index in enumerate(nodes)])
+            self.roots.append(node_id[ROOT])
+            for index in nodes:
+                address = topology[index + 1]
+                if is_leaf(topology, index):
+                    feature.append(0)
+                    threshold.append(0)
+                    left.append(node_id[index])
+                    right.append(node_id[index])
+                    leaf.append(True)
+                    p = parameters[(address + 1):(address + 1 + self.nclasses)]
+                    probabilities.append(
+                        p * parameters[address] if weighted else p)
+                else:
+                    feature.append(topology[index + 4])
+                    threshold.append(parameters[address + 1])
+                    left.append(node_id[topology[index + 2]])
+                    right.append(node_id[topology[index + 3]])
+                    leaf.append(False)
+                    probabilities.append(np.zeros(self.nclasses))
+        self.roots = np.array(self.roots, np.int32)
+        self.feature = np.array(feature, np.int64)
+        #
+        # vigra compares float32 features to float64 thresholds. Rounding
+        # each threshold up to the nearest float32 gives the same answer
+        # for every float32 feature while comparing in float32.
+        #
+        threshold = np.array(threshold, np.float64)
+        self.threshold = threshold.astype(np.float32)
+        low = self.threshold < threshold
+        self.threshold[low] = np.nextafter(self.threshold[low],
+                                           np.float32(np.inf))
+        self.left = np.array(left, np.int32)
+        self.right = np.array(right, np.int32)
+        self.is_leaf = np.array(leaf, bool)
+        self.probabilities = np.array(probabilities, np.float64)
+
+    @classmethod
+    def load(cls, group, threads = 1, early_exit = None, tolerance = 0):
+        '''Load the forest that RandomForest.writeHDF5 wrote to an HDF5 group'''
+        weighted = False
+        if OPTIONS_GROUP in group.keys() and \
+           "predict_weighted_" in group[OPTIONS_GROUP].keys():
+            weighted = bool(group[OPTIONS_GROUP]["predict_weighted_"][0])
+        return cls(read_trees(group), weighted, threads, early_exit, tolerance)
+
+    @property
+    def ntrees(self):
+        return len(self.roots)
+
+    def tree_probabilities(self, flat, row_offsets, trees):
+        '''Return the sum of some trees' leaf probabilities for a batch
+
+        flat - the batch's N x M feature matrix, flattened
+        row_offsets - the offset of each row of the matrix in flat
+        trees - the indices of the trees to walk
+        '''
+        total = np.zeros((len(row_offsets), self.nclasses))
+        for tree in trees:
+            node = np.empty(len(row_offsets), np.int32)
+            node[:] = self.roots[tree]
+            active = np.arange(len(row_offsets))
+            if self.is_leaf[self.roots[tree]]:
+                active = active[:0]
+            while len(active) > 0:
+                current = node[active]
+                values = flat.take(row_offsets[active] + self.feature[current])
+                current = np.where(values < self.threshold[current],
+                                   self.left[current], self.right[current])
+                node[active] = current
+                active = active[~ self.is_leaf[current]]
+            total += self.probabilities[node]
+        return total
+
+    def walk(self, flat, row_offsets, trees, pool = None):
+        '''Return tree_probabilities, splitting the trees over a thread pool'''
+        if pool is None or len(trees) == 1:
+            return self.tree_probabilities(flat, row_offsets, trees)
+        groups = [trees[t::self.threads] for t in range(self.threads)]
+        return sum(pool.map(
+            lambda group: self.tree_probabilities(flat, row_offsets, group),
+            [group for group in groups if len(group) > 0]))
+
+    def early_exit_probabilities(self, flat, row_offsets, pool = None):
+        '''Return the sum of the leaf probabilities of the trees walked
+
+        Each row stops once it is decided (see early_exit and tolerance).
+        '''
+        total = np.zeros((len(row_offsets), self.nclasses))
+        active = np.arange(len(row_offsets))
+        half = self.ntrees / 2.0
+        for start in range(0, self.ntrees, self.early_exit):
+            trees = range(start, min(start + self.early_exit, self.ntrees))
+            total[active] += self.walk(flat, row_offsets[active], trees, pool)
+            self.trees_walked += len(active) * len(trees)
+            #
+            # Each tree adds at most 1 to a row's class 1 total, so the
+            # total over all the trees is between votes and votes + left.
+            #
+            walked = trees[-1] + 1
+            left = self.ntrees - walked
+            votes = total[active, 1]
+            decided = (votes > half) | (votes + left <= half)
+            if self.tolerance > 0:
+                p = votes / walked
+                decided |= left * np.maximum(p, 1 - p) <= \
+                           self.tolerance * self.ntrees
+            active = active[~ decided]
+            if len(active) == 0:
+                break
+        return total
+
+    def predictProbabilities(self, features, batch_size = 65536):
+        '''Return the class probabilities of feature vectors, as vigra does
+
+        features - an N x M matrix of feature vectors, converted to float32
+        batch_size - the number of feature vectors walked at once
+
+        returns an N x nclasses float32 matrix: the sum of the leaf
+        probabilities over the trees, normalized so each row sums to 1.
+        '''
+        features = np.ascontiguousarray(features, np.float32)
+        result = np.zeros((features.shape[0], self.nclasses), np.float32)
+        pool = ThreadPool(self.threads) if self.threads > 1 else None
+        for start in range(0, features.shape[0], batch_size):
+            batch = features[start:(start + batch_size)]
+            flat = batch.reshape(batch.size)
+            row_offsets = np.arange(batch.shape[0], dtype = np.int64) * \
+                batch.shape[1]
+            if self.early_exit is None:
+                total = self.walk(flat, row_offsets, range(self.ntrees), pool)
+                self.trees_walked += batch.shape[0] * self.ntrees
+            else:
+                total = self.early_exit_probabilities(flat, row_offsets, pool)
+            self.rows_predicted += batch.shape[0]
+            result[start:(start + batch.shape[0])] = \
+                total / np.sum(total, 1)[:, np.newaxis]
+        if pool is not None:
+            pool.close()
+        return result
+
+    @property
+    def trees_per_row(self):
+        '''The average number of trees walked per row predicted'''
+        return float(self.trees_walked) / max(1, self.rows_predicted)
+
+if __name__ == "__main__":
+    #
+    # Compare the Forest to vigra on a sample of the training features and
+    # time both.
+    #
+    import sys
+    import time
+    from vigra.learning import RandomForest
+    import tiffcvt
+    from featurecodec import FeatureCodec
+    name = sys.argv[1] if len(sys.argv) > 1 else "classifier"
+    clf = RandomForest("../challenge.h5", "/" + name)
+    dataset = tiffcvt.h5_file["training_features"]
+    features = FeatureCodec.load(dataset).decode(
+        dataset[:min(dataset.shape[0], 100000), :])
+    if name == "etclassifier":
+        from extract_features import eigenproject
+        features = eigenproject(
+            features, tiffcvt.h5_file["components"][:,:]).astype(np.float32)
+    t0 = time.time()
+    expected = clf.predictProbabilities(features)
+    print "vigra: %.2f sec" % (time.time() - t0)
+    for threads in (1, 2, 4):
+        forest = Forest.load(tiffcvt.h5_file[name], threads)
+        t0 = time.time()
+        probabilities = forest.predictProbabilities(features)
+        print "Forest, %d threads: %.2f sec, max difference %g" % (
+            threads, time.time() - t0, np.max(np.abs(probabilities - expected)))
+    for early_exit in (4, 8):
+        for tolerance in (0, .05, .1):
+            forest = Forest.load(tiffcvt.h5_file[name],
+                                 early_exit = early_exit,
+                                 tolerance = tolerance)
+            t0 = time.time()
+            probabilities = forest.predictProbabilities(features)
+            print ("Early exit every %d trees, tolerance %g: %.2f sec, "
+                   "%.1f trees per row, %.3f%% of labels changed") % (
+                       early_exit, tolerance, time.time() - t0,
+                       forest.trees_per_row, 100.0 * np.mean(
+                           (probabilities[:, 1] > .5) !=
+                           (expected[:, 1] > .5)))
+    tiffcvt.h5_file.close()
@@ -0,0 +1,95 @@
+'''Time the stages of a script and report them as JSON
+
+A StageTimer collects the duration, and optionally the number of pixels,
+of each call of a stage such as blurring, feature extraction, prediction or
+an HDF5 read or write. Its report gives each stage's call count, total
+time, percentiles of the call times and pixels per second, along with the
+script's arguments and wall time, so that runs can be compared.
+'''
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import json
+import sys
+import time
+import numpy as np
+from options import get_option
+
+PERCENTILES = (50, 90, 99)
+
+class StageTimer(object):
+    '''Collect the times of a script's stages
+
+    records - a map of stage name to a list of (seconds, pixels) per call
+    '''
+    def __init__(self):
+        self.records = OrderedDict()
+        self.start = time.time()
+
+    def clear(self):
+        '''Forget the records, e.g. those a forked process inherited'''
+        self.records = OrderedDict()
+
+    def add(self, name, seconds, pixels = 0):
+        '''Record one call of a stage'''
+        self.records.setdefault(name, []).append((seconds, pixels))
+
+    @contextmanager
+    def stage(self, name, pixels = 0):
+        '''Time the body of a with statement as one call of a stage
+
+        A body that raises is timed up to the exception.
+        '''
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - t0, pixels)
+
+    def merge(self, records):
+        '''Add the records of another timer, e.g. from a worker process'''
+        for name, calls in records.items():
+            self.records.setdefault(name, []).extend(calls)
+
+    def summary(self):
+        '''Return a map of stage name to that stage's statistics'''
+        summary = OrderedDict()
+        for name, calls in self.records.items():
+            seconds = np.array([call[0] for call in calls])
+            pixels = sum([call[1] for call in calls])
+            stats = OrderedDict([("calls", len(calls)),
+                                 ("total", float(np.sum(seconds)))])
+            for percentile in PERCENTILES:
+                stats["p%d" % percentile] = float(
+                    np.percentile(seconds, percentile))
+            stats["max"] = float(np.max(seconds))
+            if pixels > 0:
+                stats["pixels"] = int(pixels)
+                stats["pixels_per_sec"] = pixels / max(np.sum(seconds), 1e-9)
+            summary[name] = stats
+        return summary
+
+    def report(self, argv = None):
+        '''Return the JSON-serializable report of the run'''
+        if argv is None:
+            argv = sys.argv
+        return OrderedDict([
+            ("script", argv[0]),
+            ("argv", list(argv[1:])),
+            ("started", time.strftime("%Y-%m-%dT%H:%M:%S",
+                                      time.localtime(self.start))),
+            ("wall_time", time.time() - self.start),
+            ("stages", self.summary())])
+
+    def write_report(self, argv = None):
+        '''Write the report to the file given by --report=<path>, if any'''
+        if argv is None:
+            argv = sys.argv
+        path = get_option(argv, "report")
+        if path is None:
+            return
+        with open(path, "w") as fd:
+            json.dump(self.report(argv), fd, indent = 2)
+        print "Wrote timing report to %s" % path
+
+timer = StageTimer()
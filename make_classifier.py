@@ -12,15 +12,19 @@ Outputs: classifier.h5 which has the following pieces
          predicted_test_labels - the test label predictions 
          training_features - the feature vectors for the training subset
          training_classification - the classifications of those pixels
+         training_index - the linear index of each training pixel
          classifier - the Random Forest classifier
          
          train_prediction.tif - TIF 32-bit float file of training predictions
                                 by the classifier
          test_prediction.tif - TIF 32-bit float file of test predictions
                                 by the classifier
+         reports/<time>/*.json - the stage timings of each step of the run
 '''
 
+import os
 import subprocess
+import time
 import logging
 import logging.config
 
@@ -40,6 +44,13 @@ logging.config.dictConfig({"version":1,
 logger = logging.getLogger("root")
 logger.setLevel(logging.INFO)
 logger.info("Running make_classifier")
+#
+# Each timed step writes a JSON report of its stages to the run's directory
+#
+report_dir = os.path.join("..", "reports", time.strftime("%Y%m%d-%H%M%S"))
+os.makedirs(report_dir)
+def report(name):
+    return "--report=%s" % os.path.join(report_dir, name + ".json")
 
 # Put the challenge .tif files into the .hdf file
 subprocess.call(["python", "tiffcvt.py"], stdout=subprocess.PIPE)
@@ -54,46 +65,30 @@ logger.info("Train ordinal image created")
 #
 # Create the first training set
 #
-subprocess.call(["python", "training_set.py"])
+subprocess.call(["python", "training_set.py", report("training_set")])
 logger.info("Training set created")
 #
 # Train using the training set
 #
-subprocess.call(["python", "train.py"])
+subprocess.call(["python", "train.py", report("train")])
 logger.info("First training complete")
 #
 # Score the training data
 #
-subprocess.call(["python", "score.py", "train"])
+subprocess.call(["python", "score.py", "train", report("score_train")])
 logger.info("First training scoring complete")
 #
-# Refine the training set (add false positive and negatives)
-#
-subprocess.call(["python", "training_set.py", "refine"])
-logger.info("Refined training set created")
-#
-# Retrain
-#
-subprocess.call(["python", "train.py"])
-logger.info("Second training complete")
-#
-# Rescore the training data
-#
-subprocess.call(["python", "score.py", "train"])
-logger.info("second scoring complete")
-#
-# Output a TIF of it
-#
-subprocess.call(["python", "tiffcvt.py", "write"])
-logger.info("Wrote predicted training scores")
-#
-# Score the test data
+# Refine the training set with the false positives and negatives, retrain
+# and rescore the blocks that could change for up to three rounds. The
+# final training prediction is written to a TIF.
 #
-subprocess.call(["python", "score.py", "test"])
-logger.info("Scored test data")
+subprocess.call(["python", "refine.py", "--rounds=3",
+                 "--tif=../train_prediction.tif",
+                 "--report-dir=%s" % report_dir])
+logger.info("Refinement complete, wrote predicted training scores")
 #
-# Output a TIF of it
+# Score the test data and write a TIF of it
 #
-subprocess.call(["python", "tiffcvt.py", "write", "predicted_test_labels", 
-                 "../test_prediction.tif"])
-logger.info("Wrote predicted test scores")
+subprocess.call(["python", "score.py", "test",
+                 "--tif=../test_prediction.tif", report("score_test")])
+logger.info("Scored test data, wrote predicted test scores")
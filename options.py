@@ -0,0 +1,15 @@
+'''Command-line options of the form --name=value for the scripts'''
+
+def get_option(argv, name, default = None, parse = str):
+    '''Return the value of a --name=value argument
+
+    argv - the command-line arguments, e.g. sys.argv
+    name - the option's name without the leading dashes
+    default - the value to return if the option is not given
+    parse - a function that converts the option's text to its value
+    '''
+    prefix = "--%s=" % name
+    for arg in argv:
+        if arg.startswith(prefix):
+            return parse(arg[len(prefix):])
+    return default
@@ -0,0 +1,207 @@
+'''A reflect-padded copy of an ordinal volume and its blurred images
+
+extract_features reflects every out-of-bounds ring offset back into the image
+on each call. A PaddedVolume does that work once, padding the image, its
+Laplacian of Gaussian and its Gaussian blur by the largest offset any
+sampling ring can reach, so that sampling is nothing more than adding
+offsets to the pixel coordinates.
+'''
+
+import numpy as np
+import os
+import tempfile
+from extract_features import reflect, ring_windows, ring_columns, \
+     ring_margin, ring_geometry, ring_size, n_features, feature_geometry
+
+SHARED_DIR = "/dev/shm"
+
+def shared_dir():
+    '''Return the directory for files that are shared with forked workers
+
+    The workers are forked with memory maps of the files, e.g. a padded
+    volume, so the files go in /dev/shm to stay in memory where there is
+    one and in the default temporary directory otherwise. An open HDF5
+    file is inherited by the workers too, so the scripts close or flush it
+    before forking.
+    '''
+    return SHARED_DIR if os.path.isdir(SHARED_DIR) else None
+
+def shared_file(suffix = ".npy"):
+    '''Create an empty file in shared_dir() and return its path
+
+    The caller removes the file when it is done with it.
+    '''
+    fd, path = tempfile.mkstemp(suffix, dir = shared_dir())
+    os.close(fd)
+    return path
+
+class PaddedVolume(object):
+    '''The image, LoG image and blurred image, padded by the ring margin
+
+    The padded channels are stored as a Z x 3 x X x Y array so that each
+    channel of each plane is contiguous. The backing array can be an
+    ndarray or a read-only memory map (see from_volume and load). If the
+    volume has a FeatureCodec, the planes hold its codes and sampling
+    returns codes; decode turns them into float32 features.
+    '''
+    def __init__(self, planes, margin, codec = None):
+        '''Wrap an already-padded array
+
+        planes - a Z x 3 x X x Y array of padded image, LoG and blur planes
+        margin - the padding on the x, y and z axes
+        codec - the FeatureCodec of the planes or None if they are unencoded
+        '''
+        self.planes = planes
+        self.margin = tuple(margin)
+        self.codec = codec
+        mx, my, mz = self.margin
+        self.shape = (planes.shape[2] - 2 * mx,
+                      planes.shape[3] - 2 * my,
+                      planes.shape[0] - 2 * mz)
+        self.dtype = planes.dtype
+        #
+        # The offset of each feature within the flattened planes relative
+        # to the flat index of the sampled pixel in the image channel.
+        #
+        self.feature_channel, self.feature_xyz = feature_geometry()
+        stride_c = planes.shape[2] * planes.shape[3]
+        stride_z = stride_c * 3
+        self.feature_offsets = (
+            self.feature_xyz[:, 2] * stride_z +
+            self.feature_channel * stride_c +
+            self.feature_xyz[:, 0] * planes.shape[3] +
+            self.feature_xyz[:, 1]).astype(np.int64)
+
+    @classmethod
+    def from_volume(cls, img, blur, path = None, codec = None):
+        '''Pad a volume and its blur_image output
+
+        img - the X x Y x Z ordinal image
+        blur - the output of blur_image(img)
+        path - if given, the padded planes are written to this .npy file
+               and the volume is backed by a read-only memory map of it.
+        codec - if given, the FeatureCodec used to encode the planes
+        '''
+        mx, my, mz = margin = ring_margin()
+        x = reflect(np.arange(-mx, img.shape[0] + mx), img.shape[0])
+        y = reflect(np.arange(-my, img.shape[1] + my), img.shape[1])
+        z = reflect(np.arange(-mz, img.shape[2] + mz), img.shape[2])
+        shape = (len(z), 3, len(x), len(y))
+        dtype = img.dtype if codec is None else codec.dtype
+        if path is None:
+            planes = np.empty(shape, dtype)
+        else:
+            planes = np.lib.format.open_memmap(path, "w+", dtype, shape)
+        for dest, src in enumerate(z):
+            for c, channel in enumerate(
+                (img[:, :, src], blur[:, :, src, 0], blur[:, :, src, 1])):
+                channel = channel[x[:, np.newaxis], y[np.newaxis, :]]
+                if codec is not None:
+                    channel = codec.encode_channel(c, channel)
+                planes[dest, c] = channel
+        if path is None:
+            return cls(planes, margin, codec)
+        planes.flush()
+        del planes
+        return cls.load(path, codec)
+
+    @classmethod
+    def load(cls, path, codec = None):
+        '''Memory-map padded planes saved by from_volume, read-only'''
+        return cls(np.load(path, mmap_mode="r"), ring_margin(), codec)
+
+    def block(self, x0, y0, k, shape):
+        '''Return a one-plane PaddedVolume view of part of a plane
+
+        x0, y0, k - the coordinates of the block's first pixel
+        shape - the size of the block, which is cut short at the far edges
+
+        The block's pixel 0, 0, 0 is pixel x0, y0, k of this volume.
+        '''
+        mx, my, mz = self.margin
+        x1 = min(x0 + shape[0], self.shape[0])
+        y1 = min(y0 + shape[1], self.shape[1])
+        return PaddedVolume(self.planes[k:(k + 2 * mz + 1), :,
+                                        x0:(x1 + 2 * mx), y0:(y1 + 2 * my)],
+                            self.margin, self.codec)
+
+    @property
+    def nbytes(self):
+        '''The size of the padded planes in bytes'''
+        return self.planes.size * self.planes.dtype.itemsize
+
+    @property
+    def padding_nbytes(self):
+        '''The number of bytes the padding adds to the image and blur'''
+        return self.nbytes - \
+               np.prod(self.shape) * 3 * self.planes.dtype.itemsize
+
+    def decode(self, features):
+        '''Decode sampled features as float32 if the planes are encoded'''
+        if self.codec is None:
+            return features
+        return self.codec.decode(features)
+
+    def decode_channels(self, block):
+        '''Decode a 3 x ... block of the planes as float32 if encoded'''
+        if self.codec is None:
+            return block
+        return self.codec.decode_channels(block)
+
+    def sample(self, indices, columns = None):
+        '''Sample the feature vectors of the pixels at the given indices
+
+        indices - an Nx3 array of pixel coordinates in the unpadded volume
+        columns - if given, only these features are sampled and the others
+                  are zero
+
+        returns the same NxM matrix as extract_features
+        '''
+        mx, my, mz = self.margin
+        _, nc, px, py = self.planes.shape
+        indices = indices.astype(np.int64)
+        base = ((((indices[:, 2] + mz) * nc) * px + indices[:, 0] + mx) *
+                py + indices[:, 1] + my)
+        flat = self.planes.reshape(self.planes.size)
+        if columns is None:
+            return flat.take(base[:, np.newaxis] +
+                             self.feature_offsets[np.newaxis, :])
+        sampler = np.zeros((indices.shape[0], n_features), self.dtype)
+        sampler[:, columns] = flat.take(
+            base[:, np.newaxis] + self.feature_offsets[np.newaxis, columns])
+        return sampler
+
+    def tile_features(self, i, j, k, shape = (64, 64), columns = None):
+        '''Extract the feature vectors for a dense tile of pixels
+
+        columns - if given, only these features are extracted, the others
+                  are zero and the matrix is in Fortran order
+
+        Returns the same matrix as extract_features.extract_tile_features.
+        '''
+        mx, my, mz = self.margin
+        if columns is not None:
+            #
+            # Fill the features one column at a time. The matrix is built
+            # transposed so that each column is contiguous and is returned
+            # in Fortran order.
+            #
+            sampler = np.zeros((n_features, shape[0], shape[1]), self.dtype)
+            for column in columns:
+                dx, dy, dz = self.feature_xyz[column]
+                x0, y0 = i + mx + dx, j + my + dy
+                sampler[column] = self.planes[
+                    k + mz + dz, self.feature_channel[column],
+                    x0:(x0 + shape[0]), y0:(y0 + shape[1])]
+            sampler.shape = (n_features, shape[0] * shape[1])
+            return sampler.transpose()
+        sampler = np.empty((shape[0] * shape[1], n_features), self.dtype)
+        for c, (xfv, offset, end) in enumerate(ring_columns):
+            radius, step = ring_geometry(xfv)
+            padded = self.planes[k + mz, c,
+                                 (i + mx - radius):(i + mx + shape[0] + radius),
+                                 (j + my - radius):(j + my + shape[1] + radius)]
+            target = sampler[:, offset:end]
+            target.shape = (shape[0], shape[1], ring_size, ring_size)
+            target[:] = ring_windows(padded, xfv, shape)
+        return sampler
@@ -0,0 +1,54 @@
+'''Pass on each plane of a prediction as soon as its blocks are scored
+
+score.py scores a volume block by block. A PlaneAssembler gathers the
+blocks of each plane and hands the plane to a sink, e.g. a
+tiffcvt.TifStackWriter, once the last of its blocks is scored, so the
+prediction can be written out while the rest of the volume is scored.
+Only the planes that are partly scored are kept in memory.
+'''
+
+import numpy as np
+
+class PlaneAssembler(object):
+    '''Assemble scored blocks into planes for a sink
+
+    shape - the X x Y x Z shape of the prediction
+    block_origins - the (x0, y0, k) of every block of the prediction
+    block_shape - the size of a block in the first two dimensions
+    sink - an object whose write_plane(k, plane) takes each finished plane
+    done - optional flags of the blocks that were scored by an earlier run
+    dataset - the prediction dataset holding the blocks flagged in done
+
+    The planes whose blocks are all done are read from the dataset and
+    written to the sink when the assembler is made.
+    '''
+    def __init__(self, shape, block_origins, block_shape, sink,
+                 done = None, dataset = None):
+        self.shape = shape
+        self.sink = sink
+        self.dataset = dataset
+        if done is None:
+            done = np.zeros(len(block_origins), bool)
+        self.blocks_left = np.zeros(shape[2], int)
+        self.has_done = np.zeros(shape[2], bool)
+        for (x0, y0, k), is_done in zip(block_origins, done):
+            if is_done:
+                self.has_done[k] = True
+            else:
+                self.blocks_left[k] += 1
+        self.planes = {}
+        for k in range(shape[2]):
+            if self.blocks_left[k] == 0:
+                self.sink.write_plane(k, dataset[:, :, k])
+
+    def add_block(self, x0, y0, k, score):
+        '''Add a block's scores, writing its plane if it's the last block'''
+        if k not in self.planes:
+            if self.has_done[k]:
+                self.planes[k] = self.dataset[:, :, k]
+            else:
+                self.planes[k] = np.zeros(self.shape[:2], np.float32)
+        self.planes[k][x0:(x0+score.shape[0]), y0:(y0+score.shape[1])] = score
+        self.blocks_left[k] -= 1
+        if self.blocks_left[k] == 0:
+            self.sink.write_plane(k, self.planes.pop(k))
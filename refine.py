@@ -0,0 +1,168 @@
+'''Refine the classifier by mining the training volume for hard examples
+
+usage: python refine.py [--rounds=<n>] [--rescore=<margin>] [--tif=<path>]
+                        [--report-dir=<dir>]
+
+Each round adds the false positives and false negatives of the last
+training prediction to the training set, retrains the classifier and
+rescores the training volume. The rescoring only scores the pixels that
+had errors or scores within margin of 0.5 and the pixels near them
+(score.py --rescore=<margin>), so a round costs a fraction of scoring the
+whole volume. The rounds stop after --rounds=<n> rounds or once a round
+doesn't reduce the number of errors.
+
+The pixels that aren't rescored keep the scores of an earlier classifier,
+which had no errors there, so a round's error count is a lower bound on
+its classifier's. A round whose bound isn't below the last round's count
+can't be better, so it is undone and the rounds stop. Once they stop, the
+classifier that is kept is scored on every pixel, and if it turns out to
+be no better than the one refine.py started with, that one is restored.
+
+--tif=<path> writes the final training prediction to a TIF file and
+--report-dir=<dir> writes the timing reports of each round's steps there.
+'''
+
+import h5py
+import numpy as np
+import os
+import subprocess
+import sys
+import tempfile
+from checkpoint import checkpoint_name
+from options import get_option
+
+H5_PATH = "../challenge.h5"
+PREDICTION_NAME = "predicted_train_labels"
+#
+# The datasets and groups that a round changes
+#
+ROUND_NAMES = ("classifier", PREDICTION_NAME, checkpoint_name(PREDICTION_NAME))
+#
+# The rounds are saved in a scratch file beside challenge.h5 that is
+# removed when refine.py ends
+#
+INITIAL_ROUND = "initial"
+LAST_ROUND = "last"
+
+def count_errors(h5_path, name = PREDICTION_NAME):
+    '''Return the number of misclassified pixels of the training prediction'''
+    h5_file = h5py.File(h5_path, "r")
+    try:
+        prediction = h5_file[name]
+        labels = h5_file["train_labels"]
+        return sum([int(np.sum((prediction[:, :, k] > .5) !=
+                               (labels[:, :, k] != 0)))
+                    for k in range(prediction.shape[2])])
+    finally:
+        h5_file.close()
+
+def copy_item(source, dest, name):
+    '''Copy a dataset or group to another file or group
+
+    A dataset of the same shape and type is written over in place, because
+    HDF5 doesn't reuse the space of a deleted one.
+    '''
+    item = source[name]
+    if name in dest.keys():
+        old = dest[name]
+        if (isinstance(item, h5py.Dataset) and
+            isinstance(old, h5py.Dataset) and
+            old.shape == item.shape and old.dtype == item.dtype):
+            old[...] = item[...]
+            for key, value in item.attrs.items():
+                old.attrs[key] = value
+            return
+        del old
+        del dest[name]
+    source.copy(name, dest)
+
+def save_round(h5_path, rounds_path, label):
+    '''Copy the classifier and the training prediction to the rounds file
+
+    h5_path - the path to challenge.h5
+    rounds_path - the path to the scratch HDF5 file of the saved rounds
+    label - the name of the group the round is saved in
+    '''
+    h5_file = h5py.File(h5_path, "r")
+    rounds_file = h5py.File(rounds_path, "a")
+    try:
+        group = rounds_file.require_group(label)
+        for name in ROUND_NAMES:
+            copy_item(h5_file, group, name)
+    finally:
+        rounds_file.close()
+        h5_file.close()
+
+def restore_round(h5_path, rounds_path, label):
+    '''Put back the classifier and the training prediction of a round'''
+    h5_file = h5py.File(h5_path, "a")
+    rounds_file = h5py.File(rounds_path, "r")
+    try:
+        for name in ROUND_NAMES:
+            copy_item(rounds_file[label], h5_file, name)
+    finally:
+        rounds_file.close()
+        h5_file.close()
+
+def run(args, report_dir, report_name):
+    '''Run a step of the refinement, failing if it fails'''
+    args = ["python"] + args
+    if report_dir is not None:
+        args.append("--report=%s" % os.path.join(report_dir,
+                                                  report_name + ".json"))
+    assert subprocess.call(args) == 0, "%s failed" % " ".join(args)
+
+if __name__ == "__main__":
+    rounds = get_option(sys.argv, "rounds", 1, int)
+    margin = get_option(sys.argv, "rescore", .25, float)
+    tif_path = get_option(sys.argv, "tif")
+    report_dir = get_option(sys.argv, "report-dir")
+    rescore = "--rescore=%g" % margin
+    tif = [] if tif_path is None else ["--tif=%s" % tif_path]
+    initial_errors = errors = count_errors(H5_PATH)
+    print "The training prediction has %d errors" % errors
+    fd, rounds_path = tempfile.mkstemp(
+        ".h5", dir = os.path.dirname(os.path.abspath(H5_PATH)))
+    os.close(fd)
+    os.remove(rounds_path)
+    retrained = False
+    try:
+        save_round(H5_PATH, rounds_path, INITIAL_ROUND)
+        for i in range(1, rounds + 1):
+            save_round(H5_PATH, rounds_path, LAST_ROUND)
+            run(["training_set.py", "refine"], report_dir,
+                "training_set_refine_%d" % i)
+            run(["train.py"], report_dir, "train_refined_%d" % i)
+            run(["score.py", "train", rescore], report_dir,
+                "score_train_refined_%d" % i)
+            bound = count_errors(H5_PATH)
+            print "Round %d: at least %d errors" % (i, bound)
+            if bound >= errors:
+                print "Stopping: the errors didn't decrease"
+                restore_round(H5_PATH, rounds_path, LAST_ROUND)
+                break
+            errors = bound
+            retrained = True
+        if retrained:
+            #
+            # Score every pixel with the kept classifier
+            #
+            h5_file = h5py.File(H5_PATH, "a")
+            del h5_file[checkpoint_name(PREDICTION_NAME)]
+            h5_file.close()
+            run(["score.py", "train"] + tif, report_dir, "score_train_refined")
+            errors = count_errors(H5_PATH)
+            print "The refined classifier has %d errors" % errors
+            if errors >= initial_errors:
+                print "Restoring the classifier, which had %d errors" % \
+                      initial_errors
+                restore_round(H5_PATH, rounds_path, INITIAL_ROUND)
+                retrained = False
+        if not retrained and tif_path is not None:
+            #
+            # Every block is scored, so this only writes the prediction
+            #
+            run(["score.py", "train"] + tif, report_dir, "score_train_tif")
+    finally:
+        if os.path.exists(rounds_path):
+            os.remove(rounds_path)
@@ -0,0 +1,117 @@
+'''Choose the training points of a labeled volume
+
+The training set is made of the membrane voxels, the voxels near them and a
+uniform sample of the rest of the background. The background is sampled a
+plane at a time so that its memory doesn't grow with the whole volume. The
+band around the membrane is found in one pass over a stack of moderate
+size and a plane at a time, in parallel, over a larger one.
+'''
+
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+import numpy as np
+from scipy.ndimage import binary_dilation
+
+#
+# membrane_band dilates stacks of up to this many voxels in one pass. Past
+# that, the whole stack's boolean temporaries cost more than splitting the
+# planes among the workers.
+#
+WHOLE_STACK_VOXELS = 64 * 1024 * 1024
+
+def disk(radius):
+    '''Return the footprint of the offsets within radius of its center'''
+    i, j = np.mgrid[-radius:(radius + 1), -radius:(radius + 1)]
+    return i * i + j * j <= radius * radius
+
+def band_coordinates(is_membrane, distance):
+    '''Return the coordinates of the band around membrane in a stack
+
+    is_membrane - an X x Y or X x Y x Z boolean array
+    distance - the band's width
+
+    returns an N x is_membrane.ndim int32 array of the coordinates of the
+    voxels that aren't membrane but are within distance of a membrane voxel
+    in the same plane
+    '''
+    footprint = disk(distance)
+    if is_membrane.ndim == 3:
+        footprint = footprint[:, :, np.newaxis]
+    band = binary_dilation(is_membrane, footprint) & ~ is_membrane
+    return np.argwhere(band).astype(np.int32)
+
+def plane_band_coordinates(args):
+    '''band_coordinates of one plane, given as (is_membrane, distance)'''
+    return band_coordinates(*args)
+
+def membrane_band(is_membrane, distance, workers = 1, processes = False):
+    '''Return the voxels within distance of membrane in their own plane
+
+    is_membrane - an X x Y x Z boolean array of the membrane voxels
+    distance - the band's width: a voxel is in the band if it isn't
+               membrane and the Euclidean distance to the nearest membrane
+               voxel in its plane is at most distance
+    workers - the number of threads or processes to find the bands of
+              the planes in. With one worker, or if the stack has no more
+              than WHOLE_STACK_VOXELS voxels, the whole stack is dilated
+              at once.
+    processes - use processes instead of threads
+
+    returns an N x 3 int32 array of the band's coordinates, plane by plane.
+    The band is the same as thresholding a distance transform of each
+    plane, but dilating by a disk only needs boolean temporaries.
+    '''
+    if workers == 1 or is_membrane.size <= WHOLE_STACK_VOXELS:
+        return band_coordinates(is_membrane, distance)
+    pool = (Pool if processes else ThreadPool)(workers)
+    coords = []
+    try:
+        planes = [(is_membrane[:, :, k], distance)
+                  for k in range(is_membrane.shape[2])]
+        for k, xy in enumerate(pool.imap(plane_band_coordinates, planes)):
+            xyz = np.empty((xy.shape[0], 3), np.int32)
+            xyz[:, :2] = xy
+            xyz[:, 2] = k
+            coords.append(xyz)
+    finally:
+        pool.close()
+    return np.vstack(coords)
+
+def sample_background(is_excluded, count, random_state):
+    '''Draw a uniform sample of the voxels that aren't excluded
+
+    is_excluded - an X x Y x Z boolean array of the voxels not to draw
+    count - the number of voxels to draw without replacement. If there are
+            fewer voxels than that, all of them are drawn.
+    random_state - the np.random.RandomState to draw with
+
+    returns an N x 3 array of the voxels' coordinates, plane by plane.
+
+    Of a uniform sample of the whole volume's voxels, the number that falls
+    in each plane is hypergeometric given the number drawn from the planes
+    before it. Drawing that number of voxels from each plane in turn gives
+    the same distribution while indexing only one plane's voxels at a time.
+    '''
+    nvoxels = [int(np.sum(~ is_excluded[:, :, k]))
+               for k in range(is_excluded.shape[2])]
+    left = sum(nvoxels)
+    count = min(count, left)
+    coords = np.zeros((count, 3), int)
+    drawn = 0
+    for k, n in enumerate(nvoxels):
+        left -= n
+        if drawn == count:
+            break
+        if n == 0:
+            continue
+        m = random_state.hypergeometric(n, left, count - drawn) \
+            if left > 0 else count - drawn
+        if m == 0:
+            continue
+        x, y = np.nonzero(~ is_excluded[:, :, k])
+        p = random_state.permutation(n)[:m]
+        coords[drawn:(drawn + m), 0] = x[p]
+        coords[drawn:(drawn + m), 1] = y[p]
+        coords[drawn:(drawn + m), 2] = k
+        drawn += m
+    return coords
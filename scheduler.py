@@ -0,0 +1,32 @@
+'''Group the tiles of a plane or block into prediction batches'''
+
+def tiles(shape, tile_shape = (64, 64)):
+    '''Return the (i, j, height, width) of the tiles that cover a plane
+
+    shape - the size of the plane
+    tile_shape - the largest tile size. Tiles at the far edges are cut
+                 short if the plane is not a multiple of the tile size.
+    '''
+    return [(i, j, min(tile_shape[0], shape[0] - i),
+             min(tile_shape[1], shape[1] - j))
+            for i in range(0, shape[0], tile_shape[0])
+            for j in range(0, shape[1], tile_shape[1])]
+
+def batches(tile_list, max_pixels):
+    '''Split tiles into consecutive batches of at most max_pixels pixels
+
+    Every batch has at least one tile, even if that tile alone is larger
+    than max_pixels.
+    '''
+    batch = []
+    npixels = 0
+    for tile in tile_list:
+        tile_pixels = tile[2] * tile[3]
+        if len(batch) > 0 and npixels + tile_pixels > max_pixels:
+            yield batch
+            batch = []
+            npixels = 0
+        batch.append(tile)
+        npixels += tile_pixels
+    if len(batch) > 0:
+        yield batch
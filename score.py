@@ -1,45 +1,555 @@
 from vigra.learning import RandomForest
+import atexit
+import h5py
+import multiprocessing
 import numpy as np
+import os
+import Queue
 import sys
+import subimager.client
+from options import get_option
+
+#
+# The second argument picks the classifier: the raw feature classifier by
+# default, "eigentexture" for the eigentexture classifier or "both" to score
+# with both classifiers from a single feature extraction.
+#
+mode = sys.argv[2] if len(sys.argv) > 2 and \
+       sys.argv[2] in ("eigentexture", "both") else "raw"
+use_raw = mode in ("raw", "both")
+use_eigen = mode in ("eigentexture", "both")
+classifier_names = []
+if use_raw:
+    classifier_names.append("classifier")
+if use_eigen:
+    classifier_names.append("etclassifier")
+#
+# The datasets besides the classifier that each classifier's scores depend on
+#
+classifier_inputs = dict(classifier = [],
+                         etclassifier = ["components", "feature_means",
+                                         "feature_sds"])
+#
+# With --forest=numpy, the classifiers are read into forestmodel.Forest,
+# which predicts with --threads=<n> threads, instead of vigra's RandomForest.
+# --early-exit=<n> walks the Forest's trees n at a time and stops for each
+# pixel once its label is decided or, with --tolerance=<t>, once its score
+# is within t of the whole forest's.
+#
+early_exit = get_option(sys.argv, "early-exit", None, int)
+tolerance = get_option(sys.argv, "tolerance", 0, float)
+engine = get_option(sys.argv, "forest",
+                    "vigra" if early_exit is None else "numpy")
+assert early_exit is None or engine == "numpy", \
+       "--early-exit needs --forest=numpy"
+assert engine in ("vigra", "numpy"), "The forest must be vigra or numpy"
+if engine == "vigra":
+    classifiers = [RandomForest('../challenge.h5', '/' + name)
+                   for name in classifier_names]
 
-if len(sys.argv) < 3 or sys.argv[2] != "eigentexture":
-    clf = RandomForest('../challenge.h5', '/classifier')
-else:
-    clf = RandomForest('../challenge.h5', '/etclassifier')
-    
 import tiffcvt
-from extract_features import extract_features, blur_image, extract_eigenfeatures
+from blockreader import HaloBlockReader
+from blurcache import cached_blur_image, cached_blur_dataset, report_blur
+from cascade import cascade_scores
+from checkpoint import checkpoint_dataset, mark_done, scoring_key, \
+     unsettled_pixels
+from extract_features import n_features
+from featurecodec import FeatureCodec, parse_precision
+from instrument import timer
+from paddedvolume import PaddedVolume, shared_file
+from planesink import PlaneAssembler
+from scheduler import tiles, batches
+
+if engine == "numpy":
+    from forestmodel import Forest
+    threads = get_option(sys.argv, "threads", 1, int)
+    classifiers = [Forest.load(tiffcvt.h5_file[name], threads,
+                               early_exit, tolerance)
+                   for name in classifier_names]
+#
+# With --chunked, the volume is read and scored block by block instead of
+# being loaded into memory whole.
+#
+chunked = "--chunked" in sys.argv
+#
+# With --precision=<type>, the padded planes are stored as float16, uint16
+# or uint8 codes and decoded for the classifier. The codec is fitted to the
+# volume's blur once it is read.
+#
+precision = parse_precision(sys.argv)
+#
+# With --sparse, only the features that the classifier's trees split on are
+# extracted.
+#
+sparse = "--sparse" in sys.argv
+assert not sparse or mode == "raw", \
+       "--sparse only applies to the raw feature classifier"
+#
+# --batch-mb=<n> sets the memory budget of the features that are classified
+# with one call.
+#
+batch_bytes = get_option(sys.argv, "batch-mb", 256, float) * 1e6
+#
+# With --cascade-step=<n>, every n'th pixel is scored, the scores are
+# interpolated and only the pixels whose interpolated score is within
+# --band=<b> of 0.5 are scored in full.
+#
+cascade_step = get_option(sys.argv, "cascade-step", 1, int)
+band = get_option(sys.argv, "band", .2, float)
+settings = precision
+if cascade_step > 1:
+    settings += "-cascade-%d-%g" % (cascade_step, band)
+if early_exit is not None:
+    settings += "-early-exit-%d-%g" % (early_exit, tolerance)
 
 if len(sys.argv) < 2 or sys.argv[1] == "train":
     labels_name = "%s_train_labels"
     labels_shape = tiffcvt.train_volume.shape
-    img = tiffcvt.h5_file["ordinal_train_volume"][:,:,:]
+    volume_name = "ordinal_train_volume"
 else:
     labels_name = "%s_test_labels"
     labels_shape = tiffcvt.test_volume.shape
-    img = tiffcvt.h5_file["ordinal_test_volume"][:,:,:]
+    volume_name = "ordinal_test_volume"
+
+labels_names = []
+if use_raw:
+    labels_names.append(labels_name % "predicted")
+if use_eigen:
+    labels_names.append(labels_name % "eigenpredicted")
+#
+# --tif=<path>[,<path>] streams each prediction to a TIF file a plane at a
+# time, as soon as each plane is scored. With --no-hdf5, the predictions
+# are only written to the TIF files and an interrupted run can't resume.
+#
+tif_paths = get_option(sys.argv, "tif", None, lambda value: value.split(","))
+persist = "--no-hdf5" not in sys.argv
+assert tif_paths is None or len(tif_paths) == len(labels_names), \
+       "--tif needs a file for each of %s" % ", ".join(labels_names)
+assert persist or tif_paths is not None, "--no-hdf5 needs --tif"
+if tif_paths is not None:
+    subimager.client.start_subimager()
+    atexit.register(subimager.client.stop_subimager)
 
-if len(sys.argv) < 3 or sys.argv[2] != "eigentexture":
-    extract_fn = extract_features
-    labels_name = labels_name % "predicted"
+if mode == "raw":
+    columns = None
+    if sparse:
+        from forestmodel import read_trees, used_features
+        columns = used_features(read_trees(tiffcvt.h5_file["classifier"]))
+        print "The classifier uses %d of %d features" % (
+            len(columns), n_features)
+    row_bytes = n_features * 4
+    def plane_fn(padded, k):
+        return lambda i, j, shape: [padded.decode(
+            padded.tile_features(i, j, k, shape, columns = columns))]
+    def point_fn(padded, k):
+        return lambda x, y: [padded.decode(padded.sample(
+            np.column_stack([x, y, np.ones(len(x), int) * k]), columns))]
+elif mode == "eigentexture":
+    import eigentexture
+    from eigenconv import EigenFilterBank
+    from extract_features import ring_margin
+    bank = EigenFilterBank(tiffcvt.h5_file["components"][:,:],
+                           eigentexture.means, eigentexture.sds,
+                           ring_margin())
+    row_bytes = bank.nkernels * 4
+    def plane_fn(padded, k):
+        #
+        # Filter the whole plane with the eigentexture components and
+        # hand out tiles of the result.
+        #
+        with timer.stage("eigenfilter", padded.shape[0] * padded.shape[1]):
+            efeatures = bank.plane(padded, k)
+        return lambda i, j, shape: \
+               [efeatures[i:(i+shape[0]), j:(j+shape[1]), :].reshape(
+                   shape[0] * shape[1], bank.nkernels)]
+    def point_fn(padded, k):
+        with timer.stage("eigenfilter", padded.shape[0] * padded.shape[1]):
+            efeatures = bank.plane(padded, k)
+        return lambda x, y: [efeatures[x, y, :]]
 else:
+    #
+    # Extract the raw features once and project them for the eigentexture
+    # classifier. eigentexture reads its normalization from the HDF5 file,
+    # so it is imported before the file is closed.
+    #
+    import eigentexture
+    from extract_features import eigenproject
     components = tiffcvt.h5_file["components"][:,:]
-    extract_fn = lambda img, bimg, indices:\
-       extract_eigenfeatures(img, bimg, components, indices)
-    labels_name = labels_name % "eigenpredicted"
-    
-predicted = tiffcvt.h5_file.require_dataset(labels_name,
-                                            labels_shape,
-                                            np.float32,
-                                            chunks=(64,64,1))
-bimg = blur_image(img)
-for i in range(0, img.shape[0], 64):
-    for j in range(0, img.shape[1], 64):
-        for k in range(img.shape[2]):
-            coords = np.mgrid[i:(i+64), j:(j+64),k:(k+1)].reshape(3, 64*64).transpose()
-            features = extract_fn(img, bimg, coords)
-            score = clf.predictProbabilities(features)[:,1]
-            score.shape = (64,64)
-            predicted[i:(i+64),j:(j+64),k] = score
-            print "Finished block %d, %d, %d" % (i, j, k)
-tiffcvt.h5_file.close()
+    row_bytes = (n_features + components.shape[0]) * 4
+    def plane_fn(padded, k):
+        def extract_fn(i, j, shape):
+            features = padded.decode(padded.tile_features(i, j, k, shape))
+            return [features,
+                    eigenproject(features, components).astype(np.float32)]
+        return extract_fn
+    def point_fn(padded, k):
+        def extract_fn(x, y):
+            features = padded.decode(padded.sample(
+                np.column_stack([x, y, np.ones(len(x), int) * k])))
+            return [features,
+                    eigenproject(features, components).astype(np.float32)]
+        return extract_fn
+
+if persist:
+    for name in labels_names:
+        tiffcvt.h5_file.require_dataset(
+            name, labels_shape, np.float32,
+            chunks=(min(64, labels_shape[0]), min(64, labels_shape[1]), 1))
+
+def score_points(block):
+    '''Return a function that scores pixels of a one-plane block
+
+    The function takes the pixels' x and y coordinates and returns each
+    classifier's scores for them.
+    '''
+    extract_fn = point_fn(block, 0)
+    max_points = max(1, int(batch_bytes / row_bytes))
+    def fn(x, y):
+        scores = [np.zeros(len(x), np.float32) for clf in classifiers]
+        for start in range(0, len(x), max_points):
+            end = min(start + max_points, len(x))
+            with timer.stage("extract", end - start):
+                features = extract_fn(x[start:end], y[start:end])
+            for clf, clf_features, score in zip(classifiers, features, scores):
+                with timer.stage("predict", end - start):
+                    score[start:end] = \
+                        clf.predictProbabilities(clf_features)[:, 1]
+        return scores
+    return fn
+
+def score_block(block):
+    '''Return each classifier's scores for every pixel of a one-plane block
+
+    Also returns the number of pixels that were scored in full, which is
+    less than the block's size if scoring coarse-to-fine.
+    '''
+    if cascade_step > 1:
+        #
+        # Sampling flattens the planes, so copy a block view of them once.
+        #
+        block = PaddedVolume(np.ascontiguousarray(block.planes),
+                             block.margin, block.codec)
+        return cascade_scores(block.shape[:2], score_points(block),
+                              cascade_step, band)
+    extract_fn = plane_fn(block, 0)
+    scores = [np.zeros(block.shape[:2], np.float32) for clf in classifiers]
+    for batch in batches(tiles(block.shape[:2]), batch_bytes / row_bytes):
+        npixels = sum([height * width for i, j, height, width in batch])
+        with timer.stage("extract", npixels):
+            features = zip(*[extract_fn(i, j, (height, width))
+                             for i, j, height, width in batch])
+            features = [np.vstack(clf_features) for clf_features in features]
+        for clf, clf_features, score in zip(classifiers, features, scores):
+            with timer.stage("predict", npixels):
+                probabilities = clf.predictProbabilities(clf_features)
+            offset = 0
+            for i, j, height, width in batch:
+                score[i:(i+height), j:(j+width)] = probabilities[
+                    offset:(offset + height * width), 1].reshape(height, width)
+                offset += height * width
+    return scores, block.shape[0] * block.shape[1]
+
+def score_task(x0, y0, k):
+    '''Score a block, or with --rescore only its unsettled pixels
+
+    The block's other pixels keep their earlier scores. A block that is
+    mostly unsettled is scored whole.
+    '''
+    block = read_block(x0, y0, k)
+    if rescore_mask is None:
+        return score_block(block)
+    region = (slice(x0, x0 + block.shape[0]), slice(y0, y0 + block.shape[1]),
+              k)
+    x, y = np.nonzero(rescore_mask[region])
+    if len(x) > block.shape[0] * block.shape[1] / 2:
+        return score_block(block)
+    block = PaddedVolume(np.ascontiguousarray(block.planes),
+                         block.margin, block.codec)
+    scores = [previous[region].copy() for previous in previous_scores]
+    for score, new_score in zip(scores, score_points(block)(x, y)):
+        score[x, y] = new_score
+    return scores, len(x)
+
+def score_worker(task_queue, result_queue, timing_queue):
+    '''Score the blocks of the shared padded volume named by the task queue'''
+    timer.clear()
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        index, x0, y0, k = task
+        scores, nscored = score_task(x0, y0, k)
+        result_queue.put((index, x0, y0, k, scores, nscored))
+    timing_queue.put((timer.records, tree_counts()))
+
+def plane_assemblers(h5_file):
+    '''Return a PlaneAssembler for each prediction streamed to a TIF file'''
+    if tif_paths is None:
+        return []
+    return [PlaneAssembler(labels_shape, block_origins, block_shape,
+                           tiffcvt.TifStackWriter(path, labels_shape), done,
+                           h5_file[name] if persist else None)
+            for path, name in zip(tif_paths, labels_names)]
+
+def write_block(h5_file, assemblers, index, x0, y0, k, scores, nscored):
+    '''Write a block's scores, record it as done and return the pixels skipped'''
+    if persist:
+        with timer.stage("write", scores[0].size * len(scores)):
+            for score, name in zip(scores, labels_names):
+                h5_file[name][x0:(x0+score.shape[0]),
+                              y0:(y0+score.shape[1]), k] = score
+            mark_done(h5_file, labels_names, index)
+    with timer.stage("tif", scores[0].size * len(assemblers)):
+        for score, assembler in zip(scores, assemblers):
+            assembler.add_block(x0, y0, k, score)
+    nskipped = scores[0].size - nscored
+    if nskipped > 0:
+        print "Finished block %d, %d, %d, skipped %.1f%% of its pixels" % (
+            x0, y0, k, 100.0 * nskipped / scores[0].size)
+    else:
+        print "Finished block %d, %d, %d" % (x0, y0, k)
+    return nskipped
+
+def report_skipped(nskipped):
+    '''Print the fraction of the remaining blocks' pixels that were skipped
+
+    The cascade skips pixels far from 0.5 and --rescore skips settled
+    pixels.
+    '''
+    if cascade_step > 1 or rescore_mask is not None:
+        npixels = sum([min(block_shape[0], labels_shape[0] - x0) *
+                       min(block_shape[1], labels_shape[1] - y0)
+                       for index, x0, y0, k in remaining])
+        print "Skipped %.1f%% of the pixels in %d blocks" % (
+            100.0 * nskipped / npixels, len(remaining))
+
+def report_trees():
+    '''Print the average number of trees walked per pixel with early exit'''
+    if early_exit is not None:
+        for name, clf in zip(classifier_names, classifiers):
+            print "%s walked %.1f of %d trees per pixel" % (
+                name, clf.trees_per_row, clf.ntrees)
+
+def tree_counts():
+    '''Return the early exit counters of the classifiers, if any'''
+    if early_exit is None:
+        return None
+    return [(clf.trees_walked, clf.rows_predicted) for clf in classifiers]
+
+def merge_tree_counts(counts):
+    '''Add the early exit counters of a worker to the classifiers'''
+    if counts is not None:
+        for clf, (trees_walked, rows_predicted) in zip(classifiers, counts):
+            clf.trees_walked += trees_walked
+            clf.rows_predicted += rows_predicted
+
+def check_processes(procs):
+    '''Fail if any of the processes has failed, terminating the rest
+
+    The processes wait on each other's queues, so one that dies would leave
+    the others waiting forever.
+    '''
+    failed = [p.exitcode for p in procs
+              if p.exitcode is not None and p.exitcode != 0]
+    if len(failed) > 0:
+        for p in procs:
+            if p.is_alive():
+                p.terminate()
+    assert len(failed) == 0, "%d scoring processes failed" % len(failed)
+
+def collect_timings(procs, running):
+    '''Merge the timings that processes put on the timing queue
+
+    procs - the processes whose timings are collected
+    running - all of the scoring processes, which are checked for failures
+              while waiting
+
+    Each process sends its stage records and its early exit counters. The
+    timings are taken before the processes are joined so that they aren't
+    left waiting to flush them.
+    '''
+    for _ in procs:
+        while True:
+            try:
+                records, counts = timing_queue.get(timeout = 1)
+                timer.merge(records)
+                merge_tree_counts(counts)
+                break
+            except Queue.Empty:
+                check_processes(running)
+                if not any([p.is_alive() for p in procs]):
+                    return
+
+def join_processes(procs, running):
+    '''Join processes, checking all of the scoring processes for failures'''
+    for p in procs:
+        while p.is_alive():
+            check_processes(running)
+            p.join(1)
+    check_processes(running)
+
+def write_scores(result_queue, timing_queue):
+    '''Write the scored blocks to the prediction datasets as they arrive'''
+    timer.clear()
+    h5_file = h5py.File(h5_path, "a")
+    assemblers = plane_assemblers(h5_file)
+    nskipped = 0
+    while True:
+        result = result_queue.get()
+        if result is None:
+            break
+        nskipped += write_block(h5_file, assemblers, *result)
+    report_skipped(nskipped)
+    h5_file.close()
+    timing_queue.put((timer.records, None))
+
+#
+# --processes=<n> scores blocks in n worker processes that share one
+# memory-mapped padded volume and hand their scores to a single writer
+# process.
+#
+processes = get_option(sys.argv, "processes", 1, int)
+assert processes == 1 or not chunked, \
+       "--chunked can't be combined with --processes"
+#
+# With --rescore=<margin>, a training prediction by an earlier classifier is
+# only rescored at the pixels that had errors or scores within margin of
+# 0.5 and the pixels within --rescore-radius=<r> of them. The other pixels
+# keep their scores and blocks with none to rescore are skipped.
+#
+rescore = get_option(sys.argv, "rescore", None, float)
+rescore_radius = get_option(sys.argv, "rescore-radius", 3, int)
+assert rescore is None or (persist and volume_name == "ordinal_train_volume"), \
+       "--rescore needs the training volume's labels and the HDF5 predictions"
+if chunked or processes > 1 or rescore is not None:
+    block_shape = (256, 256)
+else:
+    block_shape = labels_shape[:2]
+block_origins = [(x0, y0, k) for k in range(labels_shape[2])
+                 for x0 in range(0, labels_shape[0], block_shape[0])
+                 for y0 in range(0, labels_shape[1], block_shape[1])]
+#
+# Each prediction records the blocks that have been written so that a run
+# that is restarted picks up where the last one stopped. The record is
+# discarded if the classifier, volume or settings have changed.
+#
+done = np.zeros(len(block_origins), bool)
+rescore_mask = None
+if rescore is not None:
+    with timer.stage("settle", np.prod(labels_shape)):
+        masks = [unsettled_pixels(tiffcvt.h5_file, name, tiffcvt.train_labels,
+                                  rescore, rescore_radius)
+                 for name in labels_names]
+    if all([mask is not None for mask in masks]):
+        rescore_mask = np.any(masks, 0)
+        previous_scores = [tiffcvt.h5_file[name][:,:,:]
+                           for name in labels_names]
+        settled = np.array([not np.any(rescore_mask[
+            x0:(x0 + block_shape[0]), y0:(y0 + block_shape[1]), k])
+                            for x0, y0, k in block_origins])
+        print "Rescoring %.1f%% of the pixels, in %d of %d blocks" % (
+            100.0 * np.mean(rescore_mask), np.sum(~ settled),
+            len(block_origins))
+    del masks
+if persist:
+    done[:] = True
+    for name, classifier_name in zip(labels_names, classifier_names):
+        with timer.stage("hash"):
+            key = scoring_key(tiffcvt.h5_file[classifier_name],
+                              tiffcvt.h5_file[volume_name], settings,
+                              [tiffcvt.h5_file[input_name] for input_name
+                               in classifier_inputs[classifier_name]])
+        record = checkpoint_dataset(tiffcvt.h5_file, name, len(block_origins),
+                                    block_shape, key)
+        if rescore_mask is not None:
+            record[:] = record[:] | settled
+        done &= record[:] != 0
+remaining = [(index, ) + origin for index, origin in enumerate(block_origins)
+             if not done[index]]
+if len(remaining) < len(block_origins):
+    print "Skipping %d of %d blocks that were already scored" % (
+        len(block_origins) - len(remaining), len(block_origins))
+if len(remaining) == 0:
+    plane_assemblers(tiffcvt.h5_file)
+    tiffcvt.h5_file.close()
+    timer.write_report()
+    sys.exit(0)
+#
+# With --processes, the padded volume is shared through a memory-mapped
+# file. It is removed, and any scoring processes are stopped, even if
+# padding or scoring fails.
+#
+padded_path = shared_file() if processes > 1 else None
+running = []
+try:
+    if chunked:
+        blur_dataset = cached_blur_dataset(tiffcvt.h5_file, volume_name)
+        codec = FeatureCodec.fit(precision, blur_dataset)
+        reader = HaloBlockReader(tiffcvt.h5_file[volume_name], blur_dataset,
+                                 block_shape, codec)
+        def read_block(x0, y0, k):
+            with timer.stage("read", np.prod(block_shape)):
+                return reader.read(x0, y0, k)
+    else:
+        with timer.stage("read", np.prod(labels_shape)):
+            img = tiffcvt.h5_file[volume_name][:,:,:]
+        timings = np.zeros(img.shape[2])
+        with timer.stage("blur", img.size):
+            bimg = cached_blur_image(tiffcvt.h5_file, volume_name, img,
+                                     workers = multiprocessing.cpu_count(),
+                                     timings = timings)
+        report_blur(volume_name, timings)
+        codec = FeatureCodec.fit(precision, bimg)
+        with timer.stage("pad", img.size):
+            padded = PaddedVolume.from_volume(img, bimg, padded_path, codec)
+        del img, bimg
+        print "Padding adds %.1f MB" % (padded.padding_nbytes / 1e6)
+        read_block = lambda x0, y0, k: padded.block(x0, y0, k, block_shape)
+    if processes == 1:
+        assemblers = plane_assemblers(tiffcvt.h5_file)
+        nskipped = 0
+        for index, x0, y0, k in remaining:
+            scores, nscored = score_task(x0, y0, k)
+            nskipped += write_block(tiffcvt.h5_file, assemblers, index,
+                                    x0, y0, k, scores, nscored)
+        report_skipped(nskipped)
+        report_trees()
+        tiffcvt.h5_file.close()
+        timer.write_report()
+    else:
+        #
+        # The workers and writer are forked with the classifiers and the
+        # padded volume. Only the writer has the HDF5 file open while
+        # scoring.
+        #
+        h5_path = tiffcvt.h5_file.filename
+        tiffcvt.h5_file.close()
+        task_queue = multiprocessing.Queue()
+        result_queue = multiprocessing.Queue()
+        timing_queue = multiprocessing.Queue()
+        writer = multiprocessing.Process(target = write_scores,
+                                         args = (result_queue, timing_queue))
+        workers = [multiprocessing.Process(
+            target = score_worker,
+            args = (task_queue, result_queue, timing_queue))
+                   for _ in range(processes)]
+        running = workers + [writer]
+        for p in running:
+            p.start()
+        for task in remaining:
+            task_queue.put(task)
+        for worker in workers:
+            task_queue.put(None)
+        collect_timings(workers, running)
+        join_processes(workers, running)
+        report_trees()
+        result_queue.put(None)
+        collect_timings([writer], running)
+        join_processes([writer], running)
+        timer.write_report()
+finally:
+    for p in running:
+        if p.is_alive():
+            p.terminate()
+    if padded_path is not None:
+        os.remove(padded_path)
@@ -26,30 +26,57 @@ def copy_tif_stack_to_hdf(dest, src, name, dtype, chunk):
         h5_file[name][:,:,k] = plane
     h5_file.close()
     
-def copy_hdf_to_tif_stack(src, dest, name):
-    url = "file:" + urllib.pathname2url(os.path.abspath(dest))
-    h5_file = h5py.File(src, "r")
-    prediction = h5_file[name]
+def stack_metadata(shape):
+    '''Return the OME-XML of a 32-bit float stack
+
+    shape - the stack's size as an HDF5 dataset would hold it: y, x, z
+    '''
     metadata = subimager.omexml.OMEXML()
     pixels = metadata.image(0).Pixels
     assert isinstance(pixels, subimager.omexml.OMEXML.Pixels)
-    pixels.SizeX = prediction.shape[1]
-    pixels.SizeY = prediction.shape[0]
-    pixels.SizeZ = prediction.shape[2]
+    pixels.SizeX = shape[1]
+    pixels.SizeY = shape[0]
+    pixels.SizeZ = shape[2]
     pixels.DimensionOrder = subimager.omexml.DO_XYZCT
     pixels.PixelType = subimager.omexml.PT_FLOAT
-    pixels.plane_count = prediction.shape[2]
-    for i in range(prediction.shape[2]):
+    pixels.plane_count = shape[2]
+    for i in range(shape[2]):
         pixels.Plane(i).TheZ = i
         pixels.Plane(i).TheT = 0
         pixels.Plane(i).PositionX = 0
         pixels.Plane(i).PositionY = 0
         pixels.Plane(i).PositionZ = i * 50
-        
-    xml = metadata.to_xml()
+    return metadata.to_xml()
+
+class TifStackWriter(object):
+    '''Write the planes of a float stack to a TIF file as they are finished
+
+    dest - the name of the TIF file
+    shape - the stack's size: y, x, z
+
+    Planes are posted to subimager in order. A plane that is finished
+    before the ones ahead of it is held until they have been written.
+    '''
+    def __init__(self, dest, shape):
+        self.url = "file:" + urllib.pathname2url(os.path.abspath(dest))
+        self.xml = stack_metadata(shape)
+        self.pending = {}
+        self.next_plane = 0
+
+    def write_plane(self, k, plane):
+        self.pending[k] = plane
+        while self.next_plane in self.pending:
+            subimager.client.post_image(self.url,
+                                        self.pending.pop(self.next_plane),
+                                        self.xml, index=str(self.next_plane))
+            self.next_plane += 1
+
+def copy_hdf_to_tif_stack(src, dest, name):
+    h5_file = h5py.File(src, "r")
+    prediction = h5_file[name]
+    writer = TifStackWriter(dest, prediction.shape)
     for i in range(prediction.shape[2]):
-        subimager.client.post_image(url, prediction[:,:,i],
-                                    xml, index=str(i))
+        writer.write_plane(i, prediction[:,:,i])
             
 if __name__=="__main__":
     import sys
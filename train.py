@@ -1,13 +1,40 @@
 from vigra.learning import RandomForest
 import numpy as np
 import h5py
+import multiprocessing
+import os
+import shutil
 import sys
+import tempfile
 from tiffcvt import h5_file
+from featurecodec import FeatureCodec
+from forestmodel import merge_forests
+from instrument import timer
+from options import get_option
+from paddedvolume import shared_dir
+
+TREE_COUNT = 40
+
+def train_shard(training_set, training_class, tree_count, seed, path,
+                classifier_name):
+    '''Train some of the forest's trees and write them to their own file'''
+    clf = RandomForest(treeCount=tree_count)
+    clf.learnRF(training_set, training_class, randomSeed=seed)
+    clf.writeHDF5(path, "/"+classifier_name, True)
 
 if __name__=="__main__":
-    clf = RandomForest(treeCount=40)
-    training_set = h5_file["training_features"][:,:].astype(np.float32)
-    training_class = h5_file["training_classification"][:].astype(np.uint32)
+    #
+    # --processes=<n> trains the trees in n processes, each with its own
+    # seed, on a memory-mapped copy of the training set. Their forests are
+    # merged into one classifier that scores like a single forest. Each
+    # process trains at least one tree, so there are at most TREE_COUNT.
+    #
+    processes = min(get_option(sys.argv, "processes", 1, int), TREE_COUNT)
+    codec = FeatureCodec.load(h5_file["training_features"])
+    with timer.stage("read"):
+        training_set = codec.decode(h5_file["training_features"][:,:])
+        training_class = \
+            h5_file["training_classification"][:].astype(np.uint32)
     if len(sys.argv) > 1 and sys.argv[1] == "eigentexture":
         from eigentexture import normalize
         training_set = normalize(training_set)
@@ -16,11 +43,61 @@ if __name__=="__main__":
         classifier_name = "etclassifier"
     else:
         classifier_name = "classifier"
-    clf.learnRF(training_set, training_class)
-    if classifier_name in h5_file.keys():
-        del h5_file[classifier_name]
-    h5_file.close()
-    clf.writeHDF5('../challenge.h5', "/"+classifier_name, True)
+    if processes == 1:
+        clf = RandomForest(treeCount=TREE_COUNT)
+        with timer.stage("train", training_set.shape[0]):
+            clf.learnRF(training_set, training_class)
+        if classifier_name in h5_file.keys():
+            del h5_file[classifier_name]
+        h5_file.close()
+        with timer.stage("write"):
+            clf.writeHDF5('../challenge.h5', "/"+classifier_name, True)
+    else:
+        #
+        # The workers are forked with a memory map of the training set
+        #
+        h5_file.close()
+        temp_dir = tempfile.mkdtemp(dir = shared_dir())
+        try:
+            shared = np.lib.format.open_memmap(
+                os.path.join(temp_dir, "training_set.npy"), "w+",
+                np.float32, training_set.shape)
+            shared[:] = training_set
+            shared.flush()
+            del training_set
+            shard_paths = [os.path.join(temp_dir, "shard_%d.h5" % i)
+                           for i in range(processes)]
+            tree_counts = [TREE_COUNT / processes +
+                           (1 if i < TREE_COUNT % processes else 0)
+                           for i in range(processes)]
+            workers = [multiprocessing.Process(
+                target = train_shard,
+                args = (shared, training_class, tree_count, i + 1, path,
+                        classifier_name))
+                       for i, (tree_count, path)
+                       in enumerate(zip(tree_counts, shard_paths))]
+            with timer.stage("train", shared.shape[0]):
+                for worker in workers:
+                    worker.start()
+                for worker in workers:
+                    worker.join()
+            failed = [p.exitcode for p in workers if p.exitcode != 0]
+            assert len(failed) == 0, "%d training processes failed" % len(failed)
+            with timer.stage("write"):
+                shards = [h5py.File(path, "r") for path in shard_paths]
+                dest = h5py.File('../challenge.h5', "a")
+                if classifier_name in dest.keys():
+                    del dest[classifier_name]
+                ntrees = merge_forests(
+                    [shard[classifier_name] for shard in shards],
+                    dest.create_group(classifier_name))
+                dest.close()
+                for shard in shards:
+                    shard.close()
+            print "Merged %d trees from %d processes" % (ntrees, processes)
+        finally:
+            shutil.rmtree(temp_dir)
+    timer.write_report()
 else:
     classifier = RandomForest("../challenge.h5", "/classifier")
-    et_classifier = RandomForest("../challenge.h5", "/etclassifier")
\ No newline at end of file
+    et_classifier = RandomForest("../challenge.h5", "/etclassifier")
@@ -1,16 +1,68 @@
 # Sample from the training volume to get a training set
 
-from scipy.ndimage import distance_transform_edt
-import extract_features
+from blockreader import HaloBlockReader
+from blurcache import cached_blur_image, cached_blur_dataset, report_blur
+from extract_features import extract_features
+from featurecache import FeatureCache
+from featurecodec import FeatureCodec, parse_precision
+from featurelayout import parse_layout
+from instrument import timer
+from options import get_option
+from paddedvolume import PaddedVolume, shared_file
+from sampling import membrane_band, sample_background
 import tiffcvt
+import itertools
+import multiprocessing
 import numpy as np
+import os
 import sys
+import time
 r = np.random.RandomState()
 r.seed(12345)
 
-img = tiffcvt.h5_file["ordinal_train_volume"][:,:,:]
-labels = tiffcvt.train_labels[:,:,:]
-blur_img = extract_features.blur_image(img)
+#
+# With --chunked, features are sampled from the volume on disk instead of
+# from a padded copy of the whole volume in memory: chunk by chunk from the
+# volume and its cached blur if the blur is cached, otherwise block by
+# block, blurring each block as it is read.
+#
+chunked = "--chunked" in sys.argv
+#
+# --processes=<n> extracts the features in n processes that share one
+# memory-mapped padded volume. The slices are written in order as they
+# come back.
+#
+processes = get_option(sys.argv, "processes", 1, int)
+assert processes == 1 or not chunked, \
+       "--chunked can't be combined with --processes"
+#
+# With --precision=<type>, the features are sampled and stored as float16,
+# uint16 or uint8 codes. train.py and eigentexture.py decode them.
+#
+precision = parse_precision(sys.argv)
+#
+# --layout=<layout> sets the chunking and compression of training_features,
+# e.g. columns-lzf. See featurelayout.py.
+#
+layout = parse_layout(sys.argv)
+volume = tiffcvt.h5_file["ordinal_train_volume"]
+with timer.stage("read", np.prod(volume.shape)):
+    labels = tiffcvt.train_labels[:,:,:]
+if chunked:
+    blur = cached_blur_dataset(tiffcvt.h5_file, "ordinal_train_volume")
+else:
+    with timer.stage("read", np.prod(volume.shape)):
+        img = volume[:,:,:]
+    timings = np.zeros(img.shape[2])
+    with timer.stage("blur", img.size):
+        blur = cached_blur_image(tiffcvt.h5_file, "ordinal_train_volume",
+                                 img, workers = multiprocessing.cpu_count(),
+                                 timings = timings)
+    report_blur("ordinal_train_volume", timings)
+#
+# The codes' LoG range is the range of the volume's LoG
+#
+codec = FeatureCodec.fit(precision, blur)
 #
 # The idea here is to train all the membrane points because there are few
 # of them and to train all points nearby labeled points to get a sharp
@@ -19,30 +71,25 @@ blur_img = extract_features.blur_image(img)
 #
 L_MEMBRANE = 0
 distance = 3
+npts_sampled = 200000
+refine = len(sys.argv) > 1 and sys.argv[1] == "refine"
+cache = FeatureCache(tiffcvt.h5_file, volume, codec)
 is_membrane = labels == L_MEMBRANE
 coords = [np.argwhere(is_membrane)]
 pos = np.sum(is_membrane)
-for i in range(labels.shape[2]):
-    d = ((distance_transform_edt(~ is_membrane[:,:,i]) <= distance) &  
-         ~ is_membrane[:,:,i])
-    dc = np.argwhere(d)
-    coords.append(np.column_stack([dc.astype(int), np.ones(dc.shape[0], int)]))
+with timer.stage("band", labels.size):
+    coords.append(membrane_band(is_membrane, distance,
+                                workers = multiprocessing.cpu_count()))
 coords = np.vstack(coords)
 neg = coords.shape[0] - pos
-i,j,k = np.mgrid[0:labels.shape[0], 0:labels.shape[1], 0:labels.shape[2]]
-i,j,k = i.flatten(), j.flatten(), k.flatten()
-background = ~ is_membrane[i,j,k]
-i,j,k = i[background], j[background], k[background]
-p = r.permutation(len(i))[0:neg]
-coords = np.vstack([coords, np.column_stack([i[p], j[p], k[p]])])
-npts_sampled = 200000
-if len(sys.argv) > 1 and sys.argv[1] == "refine":
+coords = np.vstack([coords, sample_background(is_membrane, neg, r)])
+if refine:
     #
     # Add the false positives and false negatives to the training set
     #
     error = []
     prediction = tiffcvt.h5_file["predicted_train_labels"]
-    for plane in range(img.shape[2]):
+    for plane in range(volume.shape[2]):
         p = prediction[:,:,plane] > .5
         i,j = np.argwhere(p != (labels[:,:,plane] != 0)).transpose()
         error.append(np.column_stack([i, j, np.ones(len(i), int) * plane]))
@@ -57,23 +104,109 @@ if len(sys.argv) > 1 and sys.argv[1] == "refine":
 p = r.permutation(coords.shape[0])[:npts_sampled]
 coords = coords[p, :]
 coords = coords[np.lexsort(coords.transpose())]
+#
+# The points that were in the last training set come first, in the order of
+# their cached rows, followed by the points whose features are extracted.
+#
+rows = cache.rows(coords)
+hit = rows >= 0
+order = np.argsort(rows[hit], kind="mergesort")
+coords = np.vstack([coords[hit][order], coords[~ hit]])
+rows = rows[hit][order]
+nhits = len(rows)
+print "Reusing the features of %d of %d points" % (nhits, coords.shape[0])
 
-if ("training_features" in tiffcvt.h5_file.keys() and 
-    (tiffcvt.h5_file["training_features"].shape[1] != extract_features.n_features or
-     tiffcvt.h5_file["training_features"].shape[0] != npts_sampled)):
-    del tiffcvt.h5_file["training_features"]
+tf = cache.create_dataset(npts_sampled, codec, layout)
+if ("training_classification" in tiffcvt.h5_file.keys() and
+    tiffcvt.h5_file["training_classification"].shape[0] != npts_sampled):
     del tiffcvt.h5_file["training_classification"]
-tf = tiffcvt.h5_file.require_dataset("training_features", 
-                                     (npts_sampled, extract_features.n_features),
-                                     np.float32)
 tc = tiffcvt.h5_file.require_dataset("training_classification", 
                                      (npts_sampled, ), np.uint32)
-for i in range(0, coords.shape[0], 1024):
-    my_slice = slice(i, min(i+1024, coords.shape[0]))
-    tf[my_slice,:] = extract_features.extract_features(
-        img, blur_img, coords[my_slice,:])
-    tc[my_slice] = labels[coords[my_slice,0],
-                          coords[my_slice,1],
-                          coords[my_slice,2]]
-    print "Finished %d of %d" % (i+1024, npts_sampled)
+def cached_slices():
+    for i in range(0, nhits, 1024):
+        my_slice = slice(i, min(i+1024, nhits))
+        with timer.stage("copy", my_slice.stop - my_slice.start):
+            features = cache.read(rows[my_slice])
+        yield my_slice, features
+
+#
+# The padded volume is shared with the --processes workers through a file,
+# which is removed even if extraction fails.
+#
+padded_path = shared_file() if not chunked and processes > 1 else None
+try:
+    if chunked and blur is not None:
+        def feature_slices():
+            for i in range(nhits, coords.shape[0], 1024):
+                my_slice = slice(i, min(i+1024, coords.shape[0]))
+                with timer.stage("extract", my_slice.stop - my_slice.start):
+                    features = codec.encode(
+                        extract_features(volume, blur, coords[my_slice,:]))
+                yield my_slice, features
+    elif chunked:
+        reader = HaloBlockReader(volume, blur, codec = codec)
+        #
+        # Put the points in block order so that each block is read once
+        #
+        block = reader.block_of(coords[nhits:])
+        order = np.argsort(block, kind="mergesort")
+        coords[nhits:], block = coords[nhits:][order], block[order]
+        def feature_slices():
+            origins = reader.block_origins()
+            for idx in np.unique(block):
+                origin = np.array(origins[idx])
+                with timer.stage("read", np.prod(reader.block_shape)):
+                    padded = reader.read(*origins[idx])
+                start, end = nhits + np.searchsorted(block, [idx, idx + 1])
+                for i in range(start, end, 1024):
+                    my_slice = slice(i, min(i+1024, end))
+                    with timer.stage("extract",
+                                     my_slice.stop - my_slice.start):
+                        features = padded.sample(coords[my_slice,:] - origin)
+                    yield my_slice, features
+    else:
+        with timer.stage("pad", img.size):
+            padded = PaddedVolume.from_volume(img, blur, padded_path, codec)
+        del img, blur
+        print "Padding adds %.1f MB" % (padded.padding_nbytes / 1e6)
+        def extract_slice(my_slice):
+            t0 = time.time()
+            features = padded.sample(coords[my_slice,:])
+            return my_slice, features, time.time() - t0
+        def feature_slices():
+            slices = [slice(i, min(i+1024, coords.shape[0]))
+                      for i in range(nhits, coords.shape[0], 1024)]
+            if processes > 1:
+                #
+                # The workers are forked with the coordinates and the padded
+                # volume. The HDF5 file is still being written, so it is
+                # flushed for them. imap hands back the slices in order.
+                #
+                tiffcvt.h5_file.flush()
+                pool = multiprocessing.Pool(processes)
+                results = pool.imap(extract_slice, slices)
+            else:
+                pool = None
+                results = itertools.imap(extract_slice, slices)
+            try:
+                for my_slice, features, seconds in results:
+                    timer.add("extract", seconds,
+                              my_slice.stop - my_slice.start)
+                    yield my_slice, features
+            finally:
+                if pool is not None:
+                    pool.terminate()
+    for my_slice, features in itertools.chain(cached_slices(),
+                                              feature_slices()):
+        with timer.stage("write", my_slice.stop - my_slice.start):
+            tf[my_slice,:] = features
+            tc[my_slice] = labels[coords[my_slice,0],
+                                  coords[my_slice,1],
+                                  coords[my_slice,2]]
+        print "Finished %d of %d" % (my_slice.stop, npts_sampled)
+    cache.store(tf, coords)
+finally:
+    if padded_path is not None:
+        os.remove(padded_path)
 tiffcvt.h5_file.close()
+timer.write_report()